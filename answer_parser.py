@@ -0,0 +1,101 @@
+import re
+import misc
+
+# 引用标记：[1]、全角［1］或【1】
+citation_pattern = re.compile(r'\[(\d+)\]|［(\d+)］|【(\d+)】')
+# 句末标点后的右引号/括号归入前一句
+closing = r'["\'”’)\]）】]*'
+# 边界后紧跟的引用标记归入前一句
+trailing_citations = r'(?P<refs>(?:\s*(?:\[\d+\]|［\d+］|【\d+】))*)'
+# 句子边界按语言区分，与原来一致：中文只按中文句末标点断句；
+# 英文句末标点后面必须是空白、结尾或引用，因此 3.5、example.com 之类不会断开
+boundary_patterns = {
+    'Chinese': re.compile(r'(?P<end>[。！？]+' + closing + r')' + trailing_citations),
+    'English': re.compile(r'(?P<end>[.!?]+' + closing + r')(?=\s|$|[\[［【])' + trailing_citations),
+}
+# 流式输入时，剩余文本只有空白或不完整的引用标记，还无法确定边界后的引用是否结束
+pending_pattern = re.compile(r'\s*(?:[\[［【]\d*)?$')
+word_before_pattern = re.compile(r'(?<![A-Za-z.])([A-Za-z][A-Za-z.]*)$')
+# 以 "." 结尾但不表示句子结束的常见缩写（小写，不含最后的 "."）
+abbreviations = {
+    'e.g', 'i.e', 'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'fig', 'figs', 'nos',
+    'vol', 'pp', 'inc', 'ltd', 'corp', 'dept', 'approx', 'al', 'u.s', 'u.k', 'a.m', 'p.m',
+}
+# 连写的首字母缩写，如 J.R.R、U.S.A；单独一个大写字母（World War I.）不视为缩写
+initials_pattern = re.compile(r'[A-Za-z](?:\.[A-Za-z])+$')
+
+# 判断 "." 是否属于缩写
+def is_abbreviation(text, end):
+    # 只看 "." 前面的一小段，避免长文本中每个边界都从头搜索
+    match = word_before_pattern.search(text, max(0, end - 16), end)
+    if match is None:
+        return False
+    word = match.group(1)
+    return word.lower() in abbreviations or initials_pattern.match(word) is not None
+
+# 按 idx 建立参考文献索引，与原来的线性查找一致，idx 重复时取第一个
+def build_ref_index(references: list):
+    ref_index = {}
+    for ref in references:
+        ref_index.setdefault(int(ref["idx"]), ref["ref_id"])
+    return ref_index
+
+# 提取语句中的数字引用及其在 ref_index 中的 ref_id，找不到的引用忽略
+def extract_citations(sentence, ref_index):
+    ref_ids = []
+    for match in citation_pattern.finditer(sentence):
+        number = int(match.group(1) or match.group(2) or match.group(3))
+        ref_id = ref_index.get(number)
+        if ref_id is not None:
+            ref_ids.append({"idx": number, "ref_id": ref_id})
+    return ref_ids
+
+# 回答解析器：参考文献按 idx 只建一次索引，同一轮的各模型回答共用
+class AnswerParser:
+    def __init__(self, references: list, lang: str):
+        self.ref_index = build_ref_index(references)
+        self.boundary_pattern = boundary_patterns['Chinese' if lang == 'Chinese' else 'English']
+
+    def citations(self, sentence):
+        return extract_citations(sentence, self.ref_index)
+
+    # 在 text 中查找句子，返回 (句子列表, 已处理到的位置)；final 为 False 时不处理可能还不完整的末尾
+    def scan(self, text, final=True):
+        sentences = []
+        start = 0
+        for match in self.boundary_pattern.finditer(text):
+            if match.group('end').startswith('.') and is_abbreviation(text, match.start()):
+                continue
+            if not final and pending_pattern.match(text, match.end()):
+                break
+            # 句子不含句末的 "." 和 "。"，保留其他标点、右引号/括号和紧跟的引用
+            body = text[start:match.start()]
+            punctuation = match.group('end').strip('.。')
+            sentences.append(body + punctuation + match.group('refs'))
+            start = match.end()
+        if final:
+            sentences.append(text[start:])
+            start = len(text)
+        return [sentence.strip('\n ') for sentence in sentences if sentence.strip('\n ') != ''], start
+
+    def sentence_dict(self, index, sentence):
+        sentence_dict = {}
+        sentence_dict['sentence_id'] = misc.generate_random_code()
+        sentence_dict['idx'] = index
+        sentence_dict['sentence_string'] = sentence
+        sentence_dict['references'] = self.citations(sentence)
+        return sentence_dict
+
+    # 将回答逐句拆开，并组成特定结构
+    def split(self, answer: str):
+        sentences, _ = self.scan(answer or "")
+        return [self.sentence_dict(index + 1, sentence) for index, sentence in enumerate(sentences)]
+
+# 一次处理一个文件中所有会话的所有回答：每轮的参考文献只建一次索引，已分句的回答（流式模式）跳过
+def split_conversation_answers(conversations: list, lang: str):
+    for conversation in conversations:
+        parser = AnswerParser(conversation['references'], lang)
+        for answer_dict in conversation.get('answers', []):
+            if answer_dict.get('sentences') is None:
+                answer_dict['sentences'] = parser.split(answer_dict['content'])
+    return conversations
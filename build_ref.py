@@ -1,18 +1,28 @@
-import os, json, time
+import os, json
+import asyncio
 import logging
-from serpapi import google_search
 import html2text
-import pymupdf, uuid
-import requests
-from pathlib import Path
+import pymupdf
+import httpx
 import misc
+import shutil
+import fetcher
+import ref_cache
+import llm_cache
+import relevance
+import check_json
+import pdf_extract
+import search_cache
+import rate_limit
+from journal import ProgressJournal
+from keyword_session import KeywordSession, split_turn
 from misc import time_it
 from misc import time_it_s
-import ollama
+import ollama_pool
 from tqdm import tqdm
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from PyPDF2 import PdfFileReader
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 data_file = "wildchat_filter.data"
 temp_dir = "temp"
@@ -22,24 +32,53 @@ prompt_q2k_en = "As a search engine expert, please rewrite the following query c
 prompt_q2k_cn = "你作为搜索引擎专家，请重写下面的查询内容为若干查询关键词，生成的查询关键词总字数不查过200字，返回的关键词以逗号间隔即可。"
 prompt_summ_cn = "用感兴趣的问题在100个字内总结以下正文。如果文档与问题无关，请返回“不相关”。尽量保留所有重要的日期、数字和姓名。\n\n"
 prompt_summ_en = "Summarize the following document within 50 words with the question of interest Return \"irrelevant\" if the document is irrelevant to the question. Try to keep all the important dates, numbers, and names.\n\n"
+# 会话内各阶段的全局并发预算，所有会话共享
+turn_workers = 16     # 同时处理的轮次数
+keyword_workers = 4   # 同时进行的关键词生成 LLM 调用数
+search_workers = 4    # 同时进行的 SerpApi 检索数
+summ_workers = 16     # 同时进行的摘要任务数，实际的 LLM 并发由 ollama_pool 按服务端并行度控制
+max_summ_count = 10   # 每轮收集的有效参考文献（摘要相关）数，收集够后停止抓取
+ref_lookahead = 4     # 按排名顺序抓取时，同时在途的抓取数
+search_num = "30"     # SerpApi 每次返回的结果数
+# 摘要前的本地相关度过滤：先按标题和摘要片段的 BM25 得分保留排名靠前的候选结果再抓取，
+# 抓取后标题、片段和正文开头命中的查询词少于 min_matched_terms 个的文档不再送入 LLM 摘要
+prefilter_keep = 20
+min_matched_terms = 2
+relevance_body_chars = 1024
+relevance_query_chars = 200   # 相关度查询由搜索关键词和截断后的用户问题组成，避免长提示词中的无关词参与匹配
+drop_irrelevant_refs = True  # 直接丢弃摘要为空或不相关的参考文献，不再需要单独运行 check_json.py
+# 摘要的token预算：正文不超过预算时整篇摘要；不超过 预算×summ_select_ratio 时挑选最相关的段落；
+# 更长的文档挑选最相关的 summ_map_chunks 组段落分别摘要，再合并摘要（map-reduce）
+summ_token_budget = 3000
+summ_chunk_tokens = 500
+summ_select_ratio = 8
+summ_map_chunks = 4
 logger = logging.getLogger(__name__)
 
-# 调用 LLM 将输入的问答对，转换为查询关键词
+_turn_executor = ThreadPoolExecutor(max_workers=turn_workers, thread_name_prefix="turn")
+_summ_executor = ThreadPoolExecutor(max_workers=summ_workers, thread_name_prefix="summ")
+_keyword_slots = threading.BoundedSemaphore(keyword_workers)
+_search_slots = threading.BoundedSemaphore(search_workers)
+
+# 调用 LLM 对消息列表生成回复，相同的消息直接使用缓存中的回复
 @time_it_s
-def llm_answer(query_string):
+def llm_chat(messages):
+    cached = llm_cache.lookup(LLM_model, messages)
+    if cached is not None:
+        return cached
     try:
-        client = ollama.Client(host=os.environ.get('OLLAMA_HTTP'))
-        response = client.chat(model=LLM_model, messages=[
-        {
-            'role': 'user',
-            'content': query_string,
-        },
-        ])
-        return response['message']['content']
+        response = rate_limit.call('ollama', ollama_pool.chat, LLM_model, messages)
+        reply = response['message']['content']
+        llm_cache.store(LLM_model, messages, reply)
+        return reply
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
         return None
 
+# 调用 LLM 回答单条提示词
+def llm_answer(query_string):
+    return llm_chat([{'role': 'user', 'content': query_string}])
+
 # 利用 html2text 获取网页内容
 def get_html_content(html_content):
     # 创建一个 HTML 到 Markdown 的转换器实例
@@ -53,161 +92,237 @@ def get_html_content(html_content):
     markdown_content = h.handle(html_content)
     return markdown_content
 
-# 利用 requests 抓取指定url的网页内容
-@time_it
-def get_webpage_content(url):
+# 利用共享的异步连接池抓取指定url的网页内容，抓取的并发数由 fetcher 统一控制
+# 响应体经过全局的 url 缓存，重复出现的网页不再重复下载
+async def aget_webpage_content(url):
     logger.info(f"开始抓取网页，{url}")
     try:
-        response = requests.get(url, timeout=(5, 20)) # 设置连接超时5秒，读取超时20秒
-        # 尝试从HTTP头信息中获取编码
-        encoding = response.apparent_encoding or 'utf-8'
-        # 确保请求成功
-        response.raise_for_status()
-        # 根据编码解码网页内容
-        content = response.content.decode(encoding)
+        # 连接超时5秒，读取超时20秒；读取完成前缓存条目保持占用，不会被淘汰
+        with await ref_cache.afetch(url) as entry:
+            # 根据推断的编码解码网页内容，并转换为 Markdown，这两步较耗CPU，放到线程中执行
+            content = await asyncio.to_thread(entry.read_text)
         # logger.info(f"抓取网页成功！ 地址：{url}")
-        return get_html_content(content)
-    except requests.exceptions.Timeout as e:
+        return await asyncio.to_thread(get_html_content, content)
+    except httpx.TimeoutException as e:
         logger.error(f"抓取网页连接超时: {e}")
         return None
-    except requests.RequestException as e:
+    except (httpx.HTTPError, fetcher.FetchError) as e:
         logger.error(f"An error occurred: {e}")
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
         return None
 
-# 抓取指定网址的pdf文件
 @time_it
-def get_pdf_content(url, conversation_hash, timeout=5, max_download_time=300):
+def get_webpage_content(url):
+    return fetcher.run(aget_webpage_content(url))
+
+# 抓取指定网址的pdf文件，经过全局的 url 缓存，文件以内容哈希命名
+# 缓存中的文件会硬链接（不支持时复制）到会话的临时目录，随会话结果一起保存
+async def aget_pdf_content(url, conversation_hash, timeout=5, max_download_time=300):
     logger.info(f"开始抓取pdf，{url}")
+    file_name = ""
     try:
-        # 生成随机的UUID作为文件名
-        file_name = str(uuid.uuid4()) + '.pdf'
-        file_path = os.path.join(f"{temp_dir}/{conversation_hash}", file_name)
-        
-        # 发送HTTP GET请求
-        response = requests.get(url, stream=True, timeout=timeout)
-        
-        # 检查请求是否成功
-        if response.status_code == 200:
-            # 获取文件总大小
-            total_size = int(response.headers.get('content-length', 0))
-            if total_size == 0:
-                logger.warning("无法获取文件大小，进度条可能无法正确显示。")
-            
-            start_time = time.time()
-            # 打开文件进行写入，并显示进度条
-            with open(file_path, 'wb') as file, tqdm(
-                desc=file_name,
-                total=total_size,
-                unit='iB',
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as progress_bar:
-                # 写入内容到文件
-                for chunk in response.iter_content(chunk_size=8192):
-                    if time.time() - start_time > max_download_time:
-                        logger.error(f"下载时间超过{max_download_time}秒，强制中断下载。")
-                        return None, file_name
-                    size = file.write(chunk)
-                    progress_bar.update(size)
-            
-            # 打印下载成功的消息
-            logger.info(f"PDF文件已下载并保存到：{file_path}")
-        else:
-            logger.info(f"下载失败，状态码：{response.status_code}, 地址：{url}")
-            return None, file_name  # 返回None表示下载失败
-    except requests.exceptions.Timeout as e:
+        with await ref_cache.afetch(url, timeout=httpx.Timeout(timeout), max_time=max_download_time,
+                                    parallel=True) as entry:
+            file_name = entry.digest + '.pdf'
+            file_path = os.path.join(f"{temp_dir}/{conversation_hash}", file_name)
+            if not os.path.exists(file_path):
+                try:
+                    os.link(entry.path, file_path)
+                except OSError:
+                    shutil.copyfile(entry.path, file_path)
+        # 打印下载成功的消息
+        logger.info(f"PDF文件已保存到：{file_path}，大小：{entry.size}字节")
+    except fetcher.FetchError as e:
+        logger.error(str(e))
+        return None, file_name
+    except httpx.TimeoutException as e:
         logger.error(f"抓取PDF连接超时: {e}")
         return None, file_name
-    except requests.RequestException as e:
+    except httpx.HTTPStatusError as e:
+        logger.info(f"下载失败，状态码：{e.response.status_code}, 地址：{url}")
+        return None, file_name  # 返回None表示下载失败
+    except httpx.HTTPError as e:
         logger.error(f"请求URL时发生错误：{e}, 地址：{url}")
         return None, file_name  # 返回None表示请求失败
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}, 地址：{url}")
         return None, file_name
-    
-    return read_pdf_by_pypdf2(file_path), file_name
 
-# 利用 pymupdf 读取指定路径的 pdf 文件内容
-def read_pdf_by_pymupdf(file_path):
-    try:
-        # 尝试打开PDF文件并读取文本
-        with pymupdf.open(file_path) as doc:
-            text = ""
-            for page in doc:
-                try:
-                    page_text = page.get_text()
-                    text += page_text + "\n"
-                except Exception as e:
-                    logger.warning(f"无法读取第 {page.number} 页: {str(e)}")
-            
-            if not text.strip():
-                logger.warning("PDF文件似乎是空的或无法提取文本")
-            else:
-                text = text.strip()  # 移除开头和结尾的空白字符
-        logger.info(f"读取：{file_path}文件内容成功！")
-        return text
-    except pymupdf.errors.FileDataError as e:
+    # 从会话目录中的硬链接（或副本）内存映射读取，缓存对象之后被淘汰也不影响读取
+    return await aread_pdf_by_pymupdf(file_path), file_name
+
+@time_it
+def get_pdf_content(url, conversation_hash, timeout=5, max_download_time=300):
+    return fetcher.run(aget_pdf_content(url, conversation_hash, timeout, max_download_time))
+
+def log_pdf_error(e):
+    if isinstance(e, pymupdf.FileDataError):
         if "zlib error: invalid distance too far back" in str(e):
             logger.error(f"PDF文件可能已损坏或格式不正确：{e}")
         elif "syntax error: invalid key in dict" in str(e):
             logger.error(f"PDF文件可能包含语法错误：{e}")
         else:
             logger.error(f"打开或读取PDF文件时发生MuPDF错误：{e}")
-        return None
-    except Exception as e:
+    else:
         logger.error(f"打开或读取PDF文件时发生未知错误：{e}")
-        return None
 
-# 利用 PyPDF2 读取指定路径的 pdf 文件内容
-def read_pdf_by_pypdf2(filepath):
+# 利用 pymupdf 读取指定路径的 pdf 文件内容，按页范围在进程池中并行抽取，受页数和字数预算限制
+def read_pdf_by_pymupdf(file_path):
     try:
-        # 打开PDF文件
-        with open(filepath, 'rb') as file:
-            # 创建PDF阅读器对象
-            pdf_reader = PdfFileReader(file)
-            # 获取PDF文档的页数
-            num_pages = pdf_reader.numPages
-            logger.info(f"该PDF文件总共有 {num_pages} 页")
-            
-            # 读取每一页的内容
-            content = []
-            for page_num in range(num_pages):
-                # 获取每一页
-                page = pdf_reader.getPage(page_num)
-                # 提取文本内容
-                content.append(page.extractText())
-            return content
-    except FileNotFoundError:
-        logger.error(f"文件未找到，请检查路径是否正确: {filepath}")
-        return None
-    except KeyError:
-        logger.error("无法提取文本，可能因为PDF是扫描图像或加密。")
+        text = pdf_extract.extract_text(file_path)
+        logger.info(f"读取：{file_path}文件内容成功！")
+        return text
+    except Exception as e:
+        log_pdf_error(e)
         return None
+
+async def aread_pdf_by_pymupdf(file_path):
+    try:
+        text = await pdf_extract.aextract_text(file_path)
+        logger.info(f"读取：{file_path}文件内容成功！")
+        return text
     except Exception as e:
-        logger.error(f"读取PDF文件时发生错误: {e}")
+        log_pdf_error(e)
         return None
 
-def gen_summ(question, title, text, lang):
+def summarize(question, title, text, lang):
     if lang == 'Chinese':
         prompt = f"{prompt_summ_cn}问题: {question}\n标题: {title}\n正文: {text}\n摘要: "
     else:
         prompt = f"{prompt_summ_en}Question: {question}\nTitle: {title}\nText: {text}\nSummary: "
     return llm_answer(prompt)
 
+# 按相关度从高到低选取文本块，总token数不超过预算，返回按原文顺序排列的块下标
+def select_chunks(ranked, chunk_tokens, budget):
+    selected = []
+    used = 0
+    for i in ranked:
+        if used + chunk_tokens[i] > budget:
+            continue
+        selected.append(i)
+        used += chunk_tokens[i]
+    return sorted(selected)
+
+# 根据正文的token数选择摘要方式，使提示词的长度与token预算相关，而与文档长度无关
+def gen_summ(question, title, text, lang):
+    token_count = misc.count_tokens(text)
+    if token_count <= summ_token_budget:
+        return summarize(question, title, text, lang)
+
+    chunks = misc.split_text_by_tokens(text, summ_chunk_tokens)
+    chunk_tokens = [misc.count_tokens(chunk) for chunk in chunks]
+    scores = relevance.bm25_scores(f"{question} {title}", chunks)
+    ranked = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)
+
+    if token_count <= summ_token_budget * summ_select_ratio:
+        selected = select_chunks(ranked, chunk_tokens, summ_token_budget)
+        logger.info(f"正文共{token_count}个token，选取最相关的{len(selected)}/{len(chunks)}个段落生成摘要")
+        return summarize(question, title, "\n".join(chunks[i] for i in selected), lang)
+
+    # map：最相关的段落按原文顺序分成若干组，每组不超过预算，分别摘要
+    selected = select_chunks(ranked, chunk_tokens, summ_token_budget * summ_map_chunks)
+    groups = []
+    group, used = [], 0
+    for i in selected:
+        if group and used + chunk_tokens[i] > summ_token_budget:
+            groups.append(group)
+            group, used = [], 0
+        group.append(chunks[i])
+        used += chunk_tokens[i]
+    if group:
+        groups.append(group)
+    logger.info(f"正文共{token_count}个token，分{len(groups)}组进行 map-reduce 摘要")
+    partials = [summarize(question, title, "\n".join(g), lang) for g in groups]
+    partials = [p for p in partials if not check_json.is_empty_summary(p)]
+    if not partials:
+        return "不相关" if lang == 'Chinese' else "irrelevant"
+    if len(partials) == 1:
+        return partials[0]
+    # reduce：合并各组的摘要
+    return summarize(question, title, "\n".join(partials), lang)
+
+# 根据链接类型抓取参考文献内容，返回 (类型, 内容, pdf文件名)
+async def afetch_reference(link, conversation_hash):
+    url = str(link).lower()
+    pdf_file_name = ""
+    if url.endswith('pdf'):
+        ref_type = 'PDF'
+        c, pdf_file_name = await aget_pdf_content(link, conversation_hash)
+    elif url.endswith('txt'):
+        ref_type = 'Text'
+        c = await aget_webpage_content(link)
+    elif url.endswith('md'):
+        ref_type = 'Markdown'
+        c = await aget_webpage_content(link)
+    else:
+        ref_type = 'WebPage'
+        c = await aget_webpage_content(link)
+    return ref_type, c, pdf_file_name
+
+# 按标题和摘要片段与查询的 BM25 得分，保留得分最高的 prefilter_keep 条候选结果，返回按原排名排列的下标
+def prefilter_results(relevance_query, organic_results):
+    docs = [f"{item.get('title', '')} {item.get('snippet', '')}" for item in organic_results]
+    scores = relevance.bm25_scores(relevance_query, docs)
+    ranked = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+    return sorted(ranked[:prefilter_keep])
+
+# 抓取后的相关度判断，只看标题、片段和正文开头
+def is_plausibly_relevant(relevance_query, ref, body):
+    text = f"{ref['title']} {ref['snippet']} {body[:relevance_body_chars]}"
+    return relevance.matched_terms(relevance_query, text) >= min_matched_terms
+
 # 根据输入的 serpapi 搜索到的 json 数据，抽取有用的内容补充到原有字典中，并返回更新后的dict
-def supplement_ref(serpapi_json: dict, content: dict, lang, conversation_hash):
-    count = 0
-    if serpapi_json['search_information']['total_results'] == 0:
+# 候选结果先经过相关度预过滤，再按排名顺序抓取，同时在途的抓取不超过 ref_lookahead 个；
+# 相关的结果一抓取完成就提交摘要，收集到 max_summ_count 条摘要相关的参考文献后停止抓取；
+# 摘要进行期间抓取不停，始终比目标数多预取 ref_lookahead 条，摘要结果不相关时可以直接补上
+def supplement_ref(serpapi_json: dict, content: dict, lang, conversation_hash, keyword=None):
+    if not serpapi_json or serpapi_json.get('search_information', {}).get('total_results', 0) == 0:
         logger.info(f"搜索结果为空，忽略本条记录！！")
         return content
-    organic_results = serpapi_json['organic_results']
+    organic_results = serpapi_json.get('organic_results', [])
+    relevance_query = f"{keyword or ''} {content['query'][:relevance_query_chars]}"
+    candidates = deque(prefilter_results(relevance_query, organic_results))
     references = []
-    for index, item in enumerate(organic_results):
+    in_flight = deque()   # 在途的抓取，按排名顺序
+    ready = deque()       # 已抓取且可能相关、等待摘要的参考文献，按排名顺序
+    summ_pending = []     # 在途的摘要
+    usable = 0            # 已得到相关摘要的参考文献数
+
+    while True:
+        # 收集已完成的摘要
+        for pair in [p for p in summ_pending if p[1].done()]:
+            summ_pending.remove(pair)
+            ref, future = pair
+            ref['summary'] = future.result()
+            if not check_json.is_empty_summary(ref['summary']):
+                usable += 1
+        if usable >= max_summ_count:
+            break
+
+        # 按排名顺序提交摘要，已有的和在途的摘要不超过目标数
+        while ready and usable + len(summ_pending) < max_summ_count:
+            ref, c = ready.popleft()
+            summ_pending.append((ref, _summ_executor.submit(gen_summ, content['query'], ref['title'], c, lang)))
+
+        # 按排名顺序补充抓取窗口：只有已完成的相关摘要计入目标数，在途的摘要和待摘要的参考文献
+        # 之外再多预取 ref_lookahead 条，不必等摘要结束后才开始下一轮抓取
+        while (candidates and len(in_flight) < ref_lookahead
+               and len(summ_pending) + len(ready) + len(in_flight) < max_summ_count - usable + ref_lookahead):
+            index = candidates.popleft()
+            in_flight.append((index, fetcher.submit(afetch_reference(organic_results[index]['link'], conversation_hash))))
+
+        if not in_flight:
+            if not summ_pending:
+                break
+            # 没有可抓取的结果了，等待任一摘要完成
+            wait([future for _, future in summ_pending], return_when=FIRST_COMPLETED)
+            continue
+
+        index, fetch_future = in_flight.popleft()
+        item = organic_results[index]
         ref = {}
-        pdf_file_name = ""
         ref['ref_id'] = misc.generate_random_code()
         ref['idx'] = index
         ref['index'] = item['position']
@@ -218,109 +333,121 @@ def supplement_ref(serpapi_json: dict, content: dict, lang, conversation_hash):
             ref['snippet'] = ""  # 如果没有snippet，设置为空字符串
         link = item['link']
         ref['url'] = link
-        url = str(link).lower()
-        if url.endswith('pdf'):
-            ref['type'] = 'PDF'
-            c, pdf_file_name = get_pdf_content(link, conversation_hash)
-        elif url.endswith('txt'):
-            ref['type'] = 'Text'
-            c = get_webpage_content(link)
-        elif url.endswith('md'):
-            ref['type'] = 'Markdown'
-            c = get_webpage_content(link)
-        else:
-            ref['type'] = 'WebPage'
-            c = get_webpage_content(link)
+        ref['type'], c, pdf_file_name = fetch_future.result()
 
         if c is None:
             logger.info("无法抓取url地址内容，忽略本条记录！！")
             continue
         else:
             ref['main_body'] = c
-            if url.endswith('pdf'):
+            if ref['type'] == 'PDF':
                 ref['pdf_file_name'] = pdf_file_name
-            if count < 10:
-                summ = gen_summ(content['query'], item['title'], c, lang)
-                ref['summary'] = summ
+            if is_plausibly_relevant(relevance_query, ref, c):
+                ready.append((ref, c))
             else:
                 ref['summary'] = ""
-            if summ is not None:
-                count += 1
-            
+
         references.append(ref)
+
+    # 已收集够参考文献，取消剩余的抓取，未提交摘要的参考文献摘要为空
+    for _, fetch_future in in_flight:
+        fetch_future.cancel()
+    for ref, _ in ready:
+        ref['summary'] = ""
+    for ref, future in summ_pending:
+        ref['summary'] = future.result()
+    logger.info(f"收集到{usable}条有效参考文献，共抓取{len(organic_results) - len(candidates) - len(in_flight)}/{len(organic_results)}条搜索结果")
+    if drop_irrelevant_refs:
+        references, dropped = check_json.del_empty_summary_from_references(references)
+        logger.info(f"丢弃了{dropped}条摘要为空或不相关的参考文献")
     content['references'] = references
     return content
 
+# 生成会话中第 i 轮的搜索关键词，关键词会话按轮次顺序调用
+def gen_keyword(json_data: dict, i, session, journal=None):
+    conversation_hash = json_data['conversation_hash']
+    query, answer = split_turn(json_data['conversations']['contents'][i])
+    keyword = journal.get(i, 'keyword') if journal else None
+    if keyword is not None:
+        # 从进度日志中恢复的关键词也要追加到会话中，保持后续轮次的上下文一致
+        session.replay(query, keyword, answer)
+        return keyword
+
+    # 利用 LLM 将问答对转换为搜索关键词，每轮只向会话追加新的问答
+    with _keyword_slots:
+        keyword = session.next_keyword(query, answer)
+    # 将关键词保存到文件中
+    query_keyword_file = f"{temp_dir}/{conversation_hash}/{conversation_hash}_{i+1}_keyword.data"
+    misc.atomic_save_json_file(keyword, query_keyword_file, 'single')
+    logger.info(f"保存搜索关键词到{query_keyword_file}文件成功！")
+    if journal and keyword is not None:
+        journal.record(i, 'keyword', keyword)
+    return keyword
+
+# 处理会话中的第 i 轮：用生成的关键词检索并补充参考文献
+# 已完成的阶段记录在进度日志中，重启后从未完成的阶段继续
+def build_turn(json_data: dict, i, params: dict, keyword, journal=None):
+    lang = json_data['conversations']['lang']
+    contents = json_data['conversations']['contents']
+    conversation_hash = json_data['conversation_hash']
+    search_result_file = f"{temp_dir}/{conversation_hash}/{conversation_hash}_{i+1}_search.data"
+
+    done = journal.get(i, 'refs') if journal else None
+    if done is not None:
+        logger.info(f"第{i+1}轮已处理完成，直接使用进度日志中的结果，hash: {conversation_hash}")
+        return done
+
+    search_result = journal.get(i, 'search') if journal else None
+    if search_result is None:
+        params = dict(params, q=keyword)
+        # 相同的关键词在其他会话或进程中已经检索过时，直接使用缓存的搜索结果
+        search_result = search_cache.lookup(params)
+        if search_result is None:
+            # 调用 SerpApi 进行检索
+            try:
+                with _search_slots:
+                    search_result = search_cache.fetch_results(params)
+                search_cache.store(params, search_result)
+            except Exception as e:
+                logger.error(f"获取搜索结果时发生错误：{e}")
+                search_result = None
+        # 将检索到的结果（包括命中缓存的结果）保存下来
+        misc.atomic_save_json_file(search_result, search_result_file, 'single')
+        logger.info(f"保存搜索结果到{search_result_file}文件成功！")
+        if journal and search_result is not None:
+            journal.record(i, 'search', search_result)
+
+    # 将搜索到的ref数据补充到原有的json数据中
+    content = supplement_ref(search_result, contents[i], lang, conversation_hash, keyword)
+    if journal and search_result is not None:
+        journal.record(i, 'refs', content)
+    return content
+
 # 调用搜索引擎，将搜索到的ref数据补充到原有的json数据中
-def build_json(json_data: dict):
+# 关键词依赖之前轮次的上下文，在同一个会话中按顺序生成；每轮的关键词生成后，
+# 检索和补充参考文献立即提交到线程池，与后续轮次的关键词生成并行，各阶段的并发数受全局预算限制
+def build_json(json_data: dict, journal=None):
     lang = json_data['conversations']['lang']
     contents = json_data['conversations']['contents']
-    new_contents = []
-    query_keyword_file = f"{temp_dir}/{json_data['conversation_hash']}/{json_data['conversation_hash']}_keyword.data"
-    search_result_file = f"{temp_dir}/{json_data['conversation_hash']}/{json_data['conversation_hash']}_search.data"
     params = {
-        "num": "100",
+        "num": search_num,
         "api_key": os.environ.get("SERPAPI_KEY"), 
         "output": "json"
     }
     if lang == 'English':
         params['hl'] = 'en'
         params['gl'] = 'us'
-        query = "query:"
-        answer = "answer:"
-        query_string = prompt_q2k_en
+        session = KeywordSession(prompt_q2k_en, "query:", "answer:", llm_chat)
     elif lang == 'Chinese':
         params['hl'] = 'zh-cn'
         params['gl'] = 'cn'
-        query = "问："
-        answer = "答："
-        query_string = prompt_q2k_cn
-    
-    # 遍历列表中的每个字典
+        session = KeywordSession(prompt_q2k_cn, "问：", "答：", llm_chat)
+
+    futures = []
     for i in range(len(contents)):
-        if lang == 'English':
-            query_string = prompt_q2k_en
-        elif lang == 'Chinese':
-            query_string = prompt_q2k_cn
-        
-        # 对于当前索引i，输出从索引0到i的所有字典中的键值对
-        for j in range(i + 1):
-            # 遍历每个字典中的键值对
-            for key, value in contents[j].items():
-                # 根据键的名称来决定输出的前缀
-                if "query" in key:
-                    query_string += f"{query} {value}\n"
-                elif "answer" in key:
-                    if j < i:
-                        query_string += f"{answer} {value}\n"
-        
-        # 利用 LLM 将问答对转换为搜索关键词
-        keyword = llm_answer(query_string)
-        # 将关键词保存到文件中
-        misc.save_json_file(keyword, query_keyword_file, 'single', 'w')
-        logger.info(f"保存搜索关键词到{query_keyword_file}文件成功！")
-
-        params['q'] = keyword
-        # 检查搜索结果文件是否已存在，如果存在则从文件中读取搜索结果，避免重复调用 SerpApi 进行检索
-        if os.path.exists(search_result_file):
-            # 如果文件已存在，从文件中读取搜索结果
-            with open(search_result_file, 'r', encoding='utf-8') as file:
-                search_result = json.load(file)
-            logger.info(f"从文件{search_result_file}中读取已有搜索结果")
-        else:
-            # 如果文件不存在，调用 SerpApi 进行检索
-            search = google_search.GoogleSearch(params)
-            try:
-                search_result = search.get_dict()
-            except Exception as e:
-                logger.error(f"获取搜索结果时发生错误：{e}")
-                search_result = None
-            # 将检索到的结果保存下来
-            misc.save_json_file(search_result, search_result_file, 'single', 'w')
-            logger.info(f"保存搜索结果到{search_result_file}文件成功！")
-        
-        # 将搜索到的ref数据补充到原有的json数据中
-        new_contents.append(supplement_ref(search_result, contents[i], lang, json_data['conversation_hash']))
+        keyword = gen_keyword(json_data, i, session, journal)
+        futures.append(_turn_executor.submit(build_turn, json_data, i, params, keyword, journal))
+    new_contents = [future.result() for future in futures]
 
     json_data['conversations']['contents'] = new_contents
     return json_data
@@ -334,13 +461,16 @@ def process_single_record(line, count, temp_dir, data_dir):
     # 确保临时目录存在
     if not os.path.exists(f"{temp_dir}/{row_dict['conversation_hash']}"):
         os.makedirs(f"{temp_dir}/{row_dict['conversation_hash']}")
-    json_dict = build_json(row_dict)
+    # 进度日志放在会话临时目录之外，不会随结果一起移动到数据目录
+    journal = ProgressJournal(f"{temp_dir}/{row_dict['conversation_hash']}.journal", row_dict['conversation_hash'])
+    json_dict = build_json(row_dict, journal)
     json_filename = f"{temp_dir}/{row_dict['conversation_hash']}/{row_dict['conversation_hash']}.json"
-    misc.save_json_file(json_dict, json_filename, "multi")
+    misc.atomic_save_json_file(json_dict, json_filename, "multi")
     logger.info(f"保存文件{json_filename}成功！")
     # 将刚才处理过的所有文件从临时目录移动到目标数据目录，并删除临时目录
     misc.move_files(f"{temp_dir}/{row_dict['conversation_hash']}", data_dir)
     os.rmdir(f"{temp_dir}/{row_dict['conversation_hash']}")
+    journal.remove()
     logger.info(f"处理完成，序号：{count}，id: {row_dict['id']}，hash: {row_dict['conversation_hash']}")
 
 def main():
@@ -369,6 +499,8 @@ def main():
         list(tqdm(executor.map(process_with_count, lines), total=len(lines)))
 
     logger.info(f"总共处理了 {count} 条记录")
+    ollama_pool.get_pool().report()
+    logger.info(f"搜索缓存统计：{search_cache.stats()}")
 
 if __name__ == "__main__":
     misc.setup_logging()
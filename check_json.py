@@ -72,6 +72,11 @@ def process_references_from_contents(contents):
     return ret, count
 
 
+def is_empty_summary(summ):
+    """summary为空（包括生成失败的None）或为"不相关"，忽略大小写、首尾空白和句末标点"""
+    return summ is None or summ.strip().strip('。.').lower() in ("不相关", "irrelevant", "")
+
+
 def del_empty_summary_from_references(references):
     """删除summary为空或为"不相关"的references数据项"""
     ret = []
@@ -79,7 +84,7 @@ def del_empty_summary_from_references(references):
     for ref in references:
         try:
             summ = ref.get('summary', '')
-            if summ not in ["不相关", "irrelevant", ""]:
+            if not is_empty_summary(summ):
                 ret.append(ref)
             else:
                 count += 1
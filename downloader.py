@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import fetcher
+
+logger = logging.getLogger(__name__)
+
+# 下载配置：服务器支持 Range 时按分段并行下载，每段直接流式写入文件中对应的偏移位置
+range_parts = 4                          # 并行下载的分段数
+min_part_size = 1024 * 1024              # 每段的最小大小，文件较小时减少分段数
+max_download_time = 300                  # 整个下载的时间上限（秒）
+max_download_bytes = 200 * 1024 * 1024   # 文件大小上限
+part_suffix = '.part'                    # 下载中的文件后缀，完成后重命名为目标文件
+state_suffix = '.part.json'              # 断点续传状态文件后缀，记录各分段已下载的字节数
+state_save_bytes = 4 * 1024 * 1024       # 每下载这么多字节保存一次进度，进程被强制结束时最多重新下载这么多
+
+_active = {}
+
+# 下载结果，headers 用于调用方记录 Content-Type、ETag 等信息
+class DownloadResult:
+    def __init__(self, url, file_path, size, headers, resumed=0):
+        self.url = url
+        self.file_path = file_path
+        self.size = size
+        self.headers = headers
+        self.resumed = resumed  # 续传时复用的已下载字节数
+
+# 解析 206 响应的 Content-Range，返回文件总大小，无法确定时返回 None
+def parse_total_size(content_range):
+    match = re.match(r'bytes\s+\d+-\d+/(\d+)', content_range or '')
+    return int(match.group(1)) if match else None
+
+def validator(headers):
+    return headers.get('etag') or headers.get('last-modified')
+
+# 将文件按分段数切分为 [start, end] 区间
+def split_ranges(size, parts=range_parts, min_part=min_part_size):
+    parts = max(1, min(parts, size // min_part))
+    step = -(-size // parts)
+    return [[start, min(start + step, size) - 1] for start in range(0, size, step)]
+
+def load_state(state_path, url, size, tag):
+    try:
+        with open(state_path, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    # 文件在服务器上已变化时不能续传
+    if state.get('url') != url or state.get('size') != size or state.get('validator') != tag:
+        return None
+    return state
+
+def save_state(state_path, state):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, state_path)
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# 下载一个分段，从已完成的位置继续；done 记录该分段已写入的字节数，written(part, size) 在每块写入后调用
+async def afetch_range(url, part_path, part, headers, timeout, deadline, written):
+    start, end, done = part
+    if start + done > end:
+        return
+    range_headers = dict(headers or {}, Range=f'bytes={start + done}-{end}')
+    response = await fetcher.afetch_to_file(url, part_path, headers=range_headers, offset=start + done,
+                                            timeout=timeout, max_bytes=end - start + 1 - done,
+                                            max_time=deadline - time.monotonic(), progress=lambda size: written(part, size),
+                                            expect_partial=True)
+    if response.status_code != 206:
+        response.raise_for_status()
+        raise fetcher.FetchError(f"服务器未按 Range 返回分段，状态码：{response.status_code}, 地址：{url}")
+
+# 按分段并行下载，进度定期保存在状态文件中，中断（包括进程被强制结束）后再次下载同一文件时从断点继续
+# 任一分段失败时取消其他分段，不再继续写入文件
+async def adownload_ranges(url, file_path, size, probe_headers, headers, parts, min_part, timeout, deadline, progress):
+    part_path = file_path + part_suffix
+    state_path = file_path + state_suffix
+    tag = validator(probe_headers)
+    state = load_state(state_path, url, size, tag) if os.path.exists(part_path) else None
+    if state is None:
+        state = {'url': url, 'size': size, 'validator': tag,
+                 'parts': [start_end + [0] for start_end in split_ranges(size, parts, min_part)]}
+        with open(part_path, 'wb') as file:
+            file.truncate(size)
+    resumed = sum(part[2] for part in state['parts'])
+    if resumed:
+        logger.info(f"从断点继续下载，已下载{resumed}/{size}字节：{url}")
+        if progress is not None:
+            progress(resumed)
+    unsaved = 0
+    # 块在 progress 回调前已写入文件，此时保存的进度不会超过文件中实际的内容
+    def written(part, size):
+        nonlocal unsaved
+        part[2] += size
+        unsaved += size
+        if unsaved >= state_save_bytes:
+            save_state(state_path, state)
+            unsaved = 0
+        if progress is not None:
+            progress(size)
+    save_state(state_path, state)
+    tasks = [asyncio.ensure_future(afetch_range(url, part_path, part, headers, timeout, deadline, written))
+             for part in state['parts']]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        save_state(state_path, state)
+    remove_files(state_path)
+    return resumed
+
+# 服务器不支持 Range 时单连接流式下载
+async def adownload_stream(url, file_path, headers, timeout, max_bytes, deadline, progress):
+    response = await fetcher.afetch_to_file(url, file_path + part_suffix, headers=headers, timeout=timeout,
+                                            max_bytes=max_bytes, max_time=deadline - time.monotonic(),
+                                            progress=progress)
+    response.raise_for_status()
+    return response
+
+async def _adownload(url, file_path, headers, parts, min_part, timeout, max_time, max_bytes, progress):
+    deadline = time.monotonic() + max_time
+    probe = await fetcher.aprobe_range(url, headers=headers, timeout=timeout)
+    probe.raise_for_status()
+    if probe.status_code == 206:
+        size = parse_total_size(probe.headers.get('content-range'))
+    else:
+        size = None
+        length = probe.headers.get('content-length')
+        # 不支持 Range，但已知文件大小时也提前检查大小上限
+        if length and max_bytes is not None and int(length) > max_bytes:
+            raise fetcher.FetchError(f"文件大小{length}字节超过{max_bytes}字节，放弃下载: {url}")
+    if size is not None and max_bytes is not None and size > max_bytes:
+        raise fetcher.FetchError(f"文件大小{size}字节超过{max_bytes}字节，放弃下载: {url}")
+
+    resumed = 0
+    response_headers = probe.headers
+    try:
+        if size:
+            resumed = await asyncio.wait_for(
+                adownload_ranges(url, file_path, size, probe.headers, headers, parts, min_part, timeout, deadline,
+                                 progress),
+                max(deadline - time.monotonic(), 0))
+        else:
+            response = await asyncio.wait_for(
+                adownload_stream(url, file_path, headers, timeout, max_bytes, deadline, progress),
+                max(deadline - time.monotonic(), 0))
+            response_headers = response.headers
+            size = response.bytes_written
+    except asyncio.TimeoutError:
+        raise fetcher.FetchError(f"下载时间超过{max_time}秒，强制中断下载: {url}")
+    os.replace(file_path + part_suffix, file_path)
+    return DownloadResult(url, file_path, size, response_headers, resumed)
+
+# 下载 url 到 file_path：先探测一次是否支持 Range，支持时分段并行下载并支持断点续传，
+# 否则单连接流式下载；超过时间或大小上限时抛出 fetcher.FetchError；min_part 为每段的最小字节数
+# 下载都在 fetcher 的后台事件循环中进行，同一进程内并发下载同一个文件时只下载一次；
+# 所有调用方都取消后下载也随之取消，分段下载的进度保留在状态文件中，下次可以续传
+async def adownload(url, file_path, headers=None, parts=range_parts, min_part=min_part_size, timeout=None,
+                    max_time=max_download_time, max_bytes=max_download_bytes, progress=None):
+    return await fetcher.ashared(_active, os.path.abspath(file_path), lambda: _adownload(
+        url, file_path, headers, parts, min_part, timeout, max_time, max_bytes, progress))
+
+def download(url, file_path, **kwargs):
+    return fetcher.run(adownload(url, file_path, **kwargs))
@@ -0,0 +1,179 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+import httpx
+import charset_normalizer
+
+logger = logging.getLogger(__name__)
+
+# 连接池与并发配置
+max_in_flight = 256             # 全局同时进行的请求数
+max_per_host = 8                # 单个主机同时进行的请求数
+max_connections = 256           # 连接池最大连接数
+max_keepalive_connections = 64  # 连接池保持的空闲长连接数
+keepalive_expiry = 30           # 空闲长连接保持时间（秒）
+default_timeout = httpx.Timeout(20, connect=5)  # 连接超时5秒，读取超时20秒
+chunk_size = 64 * 1024
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_total_slots = None
+_host_slots = {}    # 主机 -> [信号量, 正在使用或等待的请求数]，请求数归零时删除
+
+# 抓取超过大小或时间限制时抛出
+class FetchError(Exception):
+    pass
+
+# 抓取结果，content 为完整的响应体（写入文件时为空）
+class FetchResult:
+    def __init__(self, response, content=b"", bytes_written=0):
+        self.response = response
+        self.url = str(response.url)
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = content
+        self.bytes_written = bytes_written
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def text(self):
+        return decode_content(self.content)
+
+# 与 requests 的 apparent_encoding 一致，根据内容推断编码
+def apparent_encoding(content):
+    match = charset_normalizer.from_bytes(content).best()
+    return match.encoding if match is not None else None
+
+# 按推断的编码将响应体解码为字符串
+def decode_content(content):
+    encoding = apparent_encoding(content) or 'utf-8'
+    return content.decode(encoding)
+
+# 获取后台事件循环，首次调用时在独立线程中启动
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="fetcher-loop", daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+# 共享的 httpx 异步客户端，只能在后台事件循环中使用
+def _get_client():
+    global _client, _total_slots
+    if _client is None:
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        _client = httpx.AsyncClient(limits=limits, timeout=default_timeout, follow_redirects=True)
+        _total_slots = asyncio.Semaphore(max_in_flight)
+    return _client
+
+# 先占用主机名额再占用全局名额，排队等待慢主机的请求不会占着全局名额让其他主机饿死
+# 主机没有请求在使用或等待时删除其信号量，避免 _host_slots 随抓取过的主机数无限增长
+@contextlib.asynccontextmanager
+async def _slots(url):
+    host = urlsplit(url).netloc.lower()
+    slot = _host_slots.get(host)
+    if slot is None:
+        slot = _host_slots[host] = [asyncio.Semaphore(max_per_host), 0]
+    slot[1] += 1
+    try:
+        async with slot[0], _total_slots:
+            yield
+    finally:
+        slot[1] -= 1
+        if slot[1] == 0:
+            del _host_slots[host]
+
+# 流式读取响应体，超过大小或时间限制时中断
+async def _iter_body(response, max_bytes, max_time):
+    start = time.monotonic()
+    size = 0
+    async for chunk in response.aiter_bytes(chunk_size):
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise FetchError(f"响应体超过{max_bytes}字节，强制中断下载: {response.url}")
+        if max_time is not None and time.monotonic() - start > max_time:
+            raise FetchError(f"下载时间超过{max_time}秒，强制中断下载: {response.url}")
+        yield chunk
+
+# 异步抓取 url，返回包含完整响应体的 FetchResult
+async def afetch(url, headers=None, timeout=None, max_bytes=None, max_time=None):
+    client = _get_client()
+    async with _slots(url):
+        async with client.stream('GET', url, headers=headers, timeout=timeout or default_timeout) as response:
+            chunks = [chunk async for chunk in _iter_body(response, max_bytes, max_time)]
+            return FetchResult(response, b"".join(chunks))
+
+# 异步抓取 url 并流式写入文件；offset 为 None 时覆盖文件，否则从 offset 处写入已有文件
+# 响应状态码不是 2xx（expect_partial 为 True 时不是 206）时不写入文件，由调用方检查 status_code
+async def afetch_to_file(url, file_path, headers=None, offset=None, timeout=None,
+                         max_bytes=None, max_time=None, progress=None, expect_partial=False):
+    client = _get_client()
+    async with _slots(url):
+        async with client.stream('GET', url, headers=headers, timeout=timeout or default_timeout) as response:
+            if not response.is_success or (expect_partial and response.status_code != 206):
+                return FetchResult(response)
+            written = 0
+            with open(file_path, 'wb' if offset is None else 'r+b') as file:
+                if offset is not None:
+                    file.seek(offset)
+                async for chunk in _iter_body(response, max_bytes, max_time):
+                    file.write(chunk)
+                    written += len(chunk)
+                    if progress is not None:
+                        # 先写出缓冲区，回调中记录的进度（如断点续传状态）不会超过文件中实际的内容
+                        file.flush()
+                        progress(len(chunk))
+            return FetchResult(response, bytes_written=written)
+
+# 请求第一个字节来探测服务器是否支持 Range 请求，不读取响应体
+async def aprobe_range(url, headers=None, timeout=None):
+    client = _get_client()
+    headers = dict(headers or {}, Range='bytes=0-0')
+    async with _slots(url):
+        async with client.stream('GET', url, headers=headers, timeout=timeout or default_timeout) as response:
+            return FetchResult(response)
+
+# 多个调用方共享同一个任务：tasks 中 key 对应的任务不存在时调用 start() 创建，
+# 所有等待的调用方都被取消后取消该任务；取消中的任务结束后，新的调用方才会开始新的任务
+async def ashared(tasks, key, start):
+    entry = tasks.get(key)
+    if entry is None or entry[2]:
+        previous = entry[0] if entry is not None else None
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await start()
+        entry = [asyncio.ensure_future(run()), 0, False]  # [任务, 等待的调用方数, 是否已取消]
+        tasks[key] = entry
+        entry[0].add_done_callback(lambda _: tasks.pop(key) if tasks.get(key) is entry else None)
+    entry[1] += 1
+    try:
+        return await asyncio.shield(entry[0])
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and not entry[0].done():
+            entry[2] = True
+            entry[0].cancel()
+
+# 将协程提交到后台事件循环，返回 concurrent.futures.Future，可在任意线程中等待
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+# 在后台事件循环中运行协程并等待结果，供同步代码调用
+def run(coro):
+    return submit(coro).result()
+
+def fetch(url, **kwargs):
+    return run(afetch(url, **kwargs))
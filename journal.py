@@ -0,0 +1,54 @@
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 会话处理进度的预写日志：每完成一个 (conversation_hash, turn, stage) 就追加一行并 fsync，
+# 重启后读取日志，已完成的阶段直接使用记录的结果，从未完成的阶段继续
+class ProgressJournal:
+    def __init__(self, path, conversation_hash):
+        self.path = path
+        self.conversation_hash = conversation_hash
+        self._lock = threading.Lock()
+        self._records = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能只写了一半，忽略即可，该阶段会重新执行
+                    logger.warning(f"忽略进度日志中不完整的记录：{self.path}")
+                    continue
+                if record.get('conversation_hash') == self.conversation_hash:
+                    self._records[(record['turn'], record['stage'])] = record['payload']
+        if self._records:
+            logger.info(f"从进度日志{self.path}中恢复了{len(self._records)}个已完成的阶段")
+
+    # 返回已完成阶段记录的结果，未完成时返回 None
+    def get(self, turn, stage):
+        with self._lock:
+            return self._records.get((turn, stage))
+
+    def record(self, turn, stage, payload):
+        line = json.dumps({'conversation_hash': self.conversation_hash, 'turn': turn, 'stage': stage,
+                           'payload': payload}, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+            self._records[(turn, stage)] = payload
+
+    # 会话处理完成后删除日志
+    def remove(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._records.clear()
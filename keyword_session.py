@@ -0,0 +1,81 @@
+import logging
+import misc
+
+logger = logging.getLogger(__name__)
+
+# 历史消息的token预算，超过后从最早的轮次开始丢弃，限制多轮会话的提示词长度和延迟
+max_history_tokens = 3000
+
+# 每个会话一个关键词生成会话：提示词作为 system 消息，每轮只追加新的问题（以及上一轮的回答），
+# 消息前缀在轮次之间保持不变，便于 Ollama / OpenAI 服务端复用已计算的前缀缓存
+class KeywordSession:
+    def __init__(self, prompt, query_label, answer_label, chat, max_tokens=max_history_tokens):
+        self.query_label = query_label
+        self.answer_label = answer_label
+        self.chat = chat  # chat(messages) -> 回复文本，失败时返回 None
+        self.max_tokens = max_tokens
+        self.system = {'role': 'system', 'content': prompt}
+        self.turns = []      # [(user 消息, assistant 消息, token数)]
+        self.pending = ""    # 尚未成功生成关键词的上下文，并入下一轮的 user 消息
+        self.last_answer = None
+
+    def _user_content(self, query):
+        content = self.pending
+        if self.last_answer is not None:
+            content += f"{self.answer_label} {self.last_answer}\n"
+        return content + f"{self.query_label} {query}\n"
+
+    # 丢弃最早的轮次，直到历史消息不超过token预算（当前轮次总是保留）
+    def _trim(self, current_tokens):
+        total = current_tokens + sum(tokens for _, _, tokens in self.turns)
+        dropped = 0
+        while self.turns and total > self.max_tokens:
+            total -= self.turns.pop(0)[2]
+            dropped += 1
+        if dropped:
+            logger.info(f"关键词会话历史超过{self.max_tokens}个token，丢弃了最早的{dropped}轮")
+
+    def messages(self, user_content):
+        messages = [self.system]
+        for user, assistant, _ in self.turns:
+            messages += [user, assistant]
+        messages.append({'role': 'user', 'content': user_content})
+        return messages
+
+    def _append(self, user_content, keyword):
+        user = {'role': 'user', 'content': user_content}
+        assistant = {'role': 'assistant', 'content': keyword}
+        tokens = misc.count_tokens(user_content) + misc.count_tokens(keyword)
+        self.turns.append((user, assistant, tokens))
+        self.pending = ""
+
+    # 生成下一轮的搜索关键词，answer 为本轮的回答，会在下一轮作为上下文追加
+    def next_keyword(self, query, answer=None):
+        user_content = self._user_content(query)
+        self._trim(misc.count_tokens(user_content))
+        keyword = self.chat(self.messages(user_content))
+        if keyword is None:
+            self.pending = user_content
+        else:
+            self._append(user_content, keyword)
+        self.last_answer = answer
+        return keyword
+
+    # 重放已生成过的关键词（例如从进度日志中恢复），不调用 LLM
+    def replay(self, query, keyword, answer=None):
+        user_content = self._user_content(query)
+        if keyword is None:
+            self.pending = user_content
+        else:
+            self._append(user_content, keyword)
+        self.last_answer = answer
+
+# 取出会话一轮中的问题和回答
+def split_turn(turn):
+    query = answer = None
+    for key, value in turn.items():
+        if "query" in key:
+            query = value
+        elif "answer" in key:
+            answer = value
+    return query, answer
@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+import openai
+import misc
+import rate_limit
+
+logger = logging.getLogger(__name__)
+
+# OpenAI 兼容的批量接口配置
+batch_dir = "batch"                         # 批量请求和结果文件的保存目录
+batch_endpoint = "/v1/chat/completions"
+completion_window = "24h"
+poll_interval = 30                          # 轮询批量任务状态的间隔（秒）
+max_wait = 26 * 3600                        # 等待批量任务结束的时间上限（秒），略长于 completion_window
+max_batch_requests = 50000                  # 单个批量任务的请求数上限，超过时拆分为多个任务
+terminal_status = ('completed', 'failed', 'expired', 'cancelled')
+
+# 将请求写成批量接口要求的 JSONL 文件，每行一个请求，custom_id 用于合并结果
+def write_batch_file(requests, file_path):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with misc.JsonlWriter(file_path, 'w', fast=True, fsync=True) as writer:
+        for custom_id, model, messages in requests:
+            writer.write({
+                'custom_id': custom_id,
+                'method': 'POST',
+                'url': batch_endpoint,
+                'body': {'model': model, 'messages': messages},
+            })
+    return file_path
+
+# 上传请求文件并创建批量任务，返回任务 id
+def submit_batch(client, provider, file_path):
+    def create():
+        with open(file_path, 'rb') as file:
+            input_file = client.files.create(file=file, purpose='batch')
+        return client.batches.create(input_file_id=input_file.id, endpoint=batch_endpoint,
+                                     completion_window=completion_window)
+    batch = rate_limit.call(provider, create, retry_exceptions=(openai.APIConnectionError,))
+    logger.info(f"已提交批量任务 {batch.id}，请求文件：{file_path}")
+    return batch.id
+
+# 轮询批量任务直到结束，超过 timeout 秒仍未结束时取消任务并抛出 TimeoutError，由调用方改为同步生成
+def wait_batch(client, provider, batch_id, timeout=None):
+    deadline = time.monotonic() + (max_wait if timeout is None else timeout)
+    while True:
+        batch = rate_limit.call(provider, client.batches.retrieve, batch_id,
+                                retry_exceptions=(openai.APIConnectionError,))
+        if batch.status in terminal_status:
+            logger.info(f"批量任务 {batch_id} 结束，状态：{batch.status}，请求数：{batch.request_counts}")
+            return batch
+        if time.monotonic() >= deadline:
+            try:
+                client.batches.cancel(batch_id)
+            except openai.OpenAIError as e:
+                logger.warning(f"取消批量任务 {batch_id} 失败：{e}")
+            raise TimeoutError(f"批量任务 {batch_id} 等待超时，状态：{batch.status}")
+        time.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+# 下载批量任务的结果，返回 {custom_id: 回复内容}，失败的请求不在结果中
+def read_batch_results(client, provider, batch, result_path):
+    if not batch.output_file_id:
+        return {}
+    content = rate_limit.call(provider, client.files.content, batch.output_file_id,
+                              retry_exceptions=(openai.APIConnectionError,))
+    with open(result_path, 'wb') as file:
+        file.write(content.content)
+    replies = {}
+    with open(result_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = misc.loads_json_line(line)
+            response = record.get('response') or {}
+            if record.get('error') or response.get('status_code') != 200:
+                logger.warning(f"批量请求 {record.get('custom_id')} 失败：{record.get('error') or response.get('status_code')}")
+                continue
+            replies[record['custom_id']] = response['body']['choices'][0]['message']['content']
+    return replies
+
+# 以批量任务执行一组请求 [(custom_id, model, messages)]，返回 {custom_id: 回复内容}
+def run_batch(client, provider, requests, name, timeout=None):
+    replies = {}
+    for start in range(0, len(requests), max_batch_requests):
+        part = requests[start:start + max_batch_requests]
+        file_path = write_batch_file(part, os.path.join(batch_dir, f"{name}_{start // max_batch_requests}.jsonl"))
+        batch = wait_batch(client, provider, submit_batch(client, provider, file_path), timeout)
+        replies.update(read_batch_results(client, provider, batch, file_path.replace('.jsonl', '.result.jsonl')))
+    return replies
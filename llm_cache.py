@@ -0,0 +1,38 @@
+import logging
+import threading
+from kv_cache import SqliteKVCache, make_key
+
+logger = logging.getLogger(__name__)
+
+# LLM 回复缓存配置，相同的 (模型, 消息, 参数) 直接返回已有回复
+enabled = True
+cache_path = "cache/llm_cache.db"
+lru_size = 4096
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SqliteKVCache(cache_path, table='completions', lru_size=lru_size)
+    return _cache
+
+def cache_key(model, messages, params=None):
+    return make_key(model, messages, params or {})
+
+# 查找已缓存的回复，未命中时返回 None
+def lookup(model, messages, params=None):
+    if not enabled:
+        return None
+    reply = get_cache().get(cache_key(model, messages, params))
+    if reply is not None:
+        logger.info(f"命中LLM缓存，模型：{model}")
+    return reply
+
+# 缓存一次成功的回复，空回复不缓存
+def store(model, messages, reply, params=None):
+    if not enabled or not reply:
+        return
+    get_cache().put(cache_key(model, messages, params), reply)
@@ -0,0 +1,50 @@
+import logging
+import threading
+import httpx
+import openai
+import anthropic
+
+logger = logging.getLogger(__name__)
+
+# LLM 客户端连接池配置，同一 (服务商, 地址, key) 只创建一个客户端，各线程共享其连接池
+request_timeout = httpx.Timeout(120, connect=5)  # 生成回答较慢，读取超时放宽到120秒
+max_connections = 64
+max_keepalive_connections = 32
+keepalive_expiry = 60
+max_retries = 0     # 重试由 rate_limit 统一调度
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _limits():
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+def _build_client(provider, base_url, api_key):
+    if provider == 'anthropic':
+        http_client = anthropic.DefaultHttpxClient(limits=_limits(), timeout=request_timeout)
+        return anthropic.Anthropic(api_key=api_key, base_url=base_url, http_client=http_client,
+                                   timeout=request_timeout, max_retries=max_retries)
+    http_client = openai.DefaultHttpxClient(limits=_limits(), timeout=request_timeout)
+    return openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                         timeout=request_timeout, max_retries=max_retries)
+
+# 获取 (服务商, 地址, key) 对应的长期复用客户端，首次调用时创建
+def get_client(provider, base_url=None, api_key=None):
+    key = (provider, base_url, api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _build_client(provider, base_url, api_key)
+            _clients[key] = client
+            logger.debug(f"创建{provider}客户端：{base_url}")
+    return client
+
+def get_openai_client(base_url=None, api_key=None):
+    return get_client('openai', base_url, api_key)
+
+def get_anthropic_client(base_url=None, api_key=None):
+    return get_client('anthropic', base_url, api_key)
@@ -1,14 +1,29 @@
-import os, json
-import re
+import os, sys, json, time
+import atexit
 import logging
-from openai import OpenAI
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
 import anthropic
 import misc
+import llm_cache
+import llm_clients
+import llm_batch
+import rate_limit
+from answer_parser import AnswerParser, build_ref_index, extract_citations, split_conversation_answers
 from misc import time_it_s
 
 logger = logging.getLogger(__name__)
 data_dir = "data"
-openai_baseurl = "https://api.openai.com/v1"
+file_workers = 8    # 同时处理的文件数
+# 批量模式：通过 OpenAI 兼容的批量接口离线生成回答（python llm_gen_answer.py batch），
+# 仅 batch_providers 中的服务商使用批量接口，其他模型仍同步生成
+batch_mode = False
+batch_providers = ('openai',)
+# 流式模式：边生成边分句、提取引用，并把首token时间、生成速度等指标写入 metrics_file
+stream_mode = False
+metrics_file = "llm_metrics.jsonl"
+openai_baseurl = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")  # 可指向本地的兼容服务，便于测试批量模式
 openai_model = "gpt-4o"
 '''
 gpt-4o
@@ -54,43 +69,130 @@ models = {
     # kimi_model: kimi_baseurl,
     pply_model: pply_baseurl
 }
+_metrics_writer = None
+_metrics_lock = threading.Lock()
+_model_executor = ThreadPoolExecutor(max_workers=file_workers * max(1, len(models)), thread_name_prefix="model")
 prompt_cn = "说明：仅使用提供的搜索结果（其中一些可能无关紧要）为给定问题写一个准确、引人入胜、简洁的答案，并正确引用。使用公正和新闻的语气。总是引用任何事实主张。当引用多个搜索结果时，请使用[1][2][3]。每句话至少引用一份文件，最多引用三份文件。如果有多个文档支持该句子，则只引用文档中足够小的子集。\n\n"
 prompt_en = "Instruction: Write an accurate, engaging, and concise answer for the given question using only the provided search results (some of which might be irrelevant) and cite them properly. Use an unbiased and journalistic tone. Always cite for any factual claim. When citing several search results, use [1][2][3]. Cite at least one document and at most three documents in each sentence. If multiple documents support the sentence, only cite a minimum sufficient subset of the documents.\n\n"
 prompt_gen_cn = "说明：仅使用提供的搜索结果（其中一些可能无关紧要）为给定问题写一个准确、引人入胜、简洁的答案，并正确引用。使用公正和新闻的语气。总是引用任何事实主张。当引用多个搜索结果时，请使用[1][2][3]。每句话至少引用一份文件，最多引用三份文件。如果有多个文档支持该句子，则只引用文档中足够小的子集。\n\n"
 prompt_gen_en = "Instruction: Write an accurate, engaging, and concise answer for the given question using only the provided search results (some of which might be irrelevant) and cite them properly. Use an unbiased and journalistic tone. Always cite for any factual claim. When citing several search results, use [1][2][3]. Cite at least one document and at most three documents in each sentence. If multiple documents support the sentence, only cite a minimum sufficient subset of the documents.\n\n"
 
-@time_it_s
-def gen_by_ChatGPT(model, model_baseurl, query_string, conversation_history=[]):
+# 根据模型名称判断服务商，用于选择 API key 和限流器
+def model_provider(model):
     if 'gpt' in model:
-        api_key = os.environ.get("OPENAI_API_KEY")
+        return 'openai'
     elif 'moonshot' in model:
-        api_key = os.environ.get("KIMI_API_KEY")
+        return 'moonshot'
     elif 'llama' in model:
-        api_key = os.environ.get("PERPLEXITY_API_KEY")
-    else:
-        api_key = os.environ.get("WILDCARD_API_KEY")
+        return 'perplexity'
+    elif 'claude' in model:
+        return 'claude'
+    return 'wildcard'
+
+# OpenAI 兼容接口的服务商对应的 API key
+def provider_api_key(provider):
+    if provider == 'openai':
+        return os.environ.get("OPENAI_API_KEY")
+    elif provider == 'moonshot':
+        return os.environ.get("KIMI_API_KEY")
+    elif provider == 'perplexity':
+        return os.environ.get("PERPLEXITY_API_KEY")
+    return os.environ.get("WILDCARD_API_KEY")
+
+# 记录一次流式生成的延迟指标：首 token 时间、生成速度和总 token 数
+def record_stream_metrics(model, provider, start, first_token_at, end, completion_tokens):
+    generate_time = end - (first_token_at or end)
+    record = {
+        'time': round(time.time(), 3),
+        'model': model,
+        'provider': provider,
+        'ttft_ms': round((first_token_at - start) * 1000, 1) if first_token_at else None,
+        'total_ms': round((end - start) * 1000, 1),
+        'completion_tokens': completion_tokens,
+        'tokens_per_sec': round(completion_tokens / generate_time, 2) if completion_tokens and generate_time > 0 else None,
+    }
+    global _metrics_writer
+    with _metrics_lock:
+        if _metrics_writer is None:
+            _metrics_writer = misc.JsonlWriter(metrics_file, 'a', fast=True)
+            atexit.register(close_metrics_writer)
+        _metrics_writer.write(record)
+        _metrics_writer.flush()
+    logger.info(f"{model} 首token {record['ttft_ms']} ms，{record['tokens_per_sec']} tokens/s，共 {completion_tokens} tokens")
+
+def close_metrics_writer():
+    global _metrics_writer
+    with _metrics_lock:
+        if _metrics_writer is not None:
+            _metrics_writer.close()
+            _metrics_writer = None
+
+# 流式读取 OpenAI 兼容接口的回复，每个增量文本交给 stream（SentenceStream）增量分句
+# start 为发送请求前的时间，首 token 时间包含请求和排队的延迟
+def read_openai_stream(model, provider, response, stream, start):
+    first_token_at = None
+    parts = []
+    usage = None
+    for chunk in response:
+        if getattr(chunk, 'usage', None):
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            parts.append(delta)
+            stream.feed(delta)
+    end = time.monotonic()
+    reply = ''.join(parts)
+    # 服务端没有返回 usage 时按完整回复计算 token 数
+    tokens = usage.completion_tokens if usage is not None else misc.count_tokens(reply)
+    record_stream_metrics(model, provider, start, first_token_at, end, tokens)
+    return reply
+
+@time_it_s
+def gen_by_ChatGPT(model, model_baseurl, query_string, conversation_history=[], stream=None):
+    provider = model_provider(model)
+    api_key = provider_api_key(provider)
     baseurl = model_baseurl
 
     try:
-        # 初始化 OpenAI 客户端
-        client = OpenAI(
-            api_key = api_key,
-            base_url = baseurl,
-        )
+        # 获取长期复用的 OpenAI 客户端，各次调用共享连接池
+        client = llm_clients.get_openai_client(baseurl, api_key)
         logger.debug(f"Query: {query_string}")
         # 将历史对话和当前查询合并作为输入
         messages = conversation_history + [
             {"role": "user", "content": f"{query_string}"}
         ]
 
-        # 发送请求到 OpenAI 并获取回复
-        completion = client.chat.completions.create(
-            model = model,
-            messages=messages
-        )
-
-        # 获取回复内容
-        reply = completion.choices[0].message.content
+        # 相同的 (模型, 消息, 地址) 直接使用缓存中的回复
+        params = {'base_url': baseurl}
+        reply = llm_cache.lookup(model, messages, params)
+        if reply is None:
+            # 发送请求到 OpenAI 并获取回复，受该服务商的限流器控制，限流或临时错误时退避重试
+            def create():
+                if stream is not None:
+                    # 流式生成：边接收边分句，重试时重新开始分句
+                    stream.reset()
+                    extra = {'stream_options': {'include_usage': True}} if provider == 'openai' else {}
+                    start = time.monotonic()
+                    raw = client.chat.completions.with_raw_response.create(
+                        model = model,
+                        messages=messages,
+                        stream=True,
+                        **extra
+                    )
+                    return read_openai_stream(model, provider, raw.parse(), stream, start), raw.headers
+                raw = client.chat.completions.with_raw_response.create(
+                    model = model,
+                    messages=messages
+                )
+                # 获取回复内容
+                return raw.parse().choices[0].message.content, raw.headers
+            reply = rate_limit.call(provider, create, retry_exceptions=(openai.APIConnectionError,),
+                                    with_headers=True)
+            llm_cache.store(model, messages, reply, params)
 
         # 将当前回复添加到对话历史中
         conversation_history.append(
@@ -99,35 +201,70 @@ def gen_by_ChatGPT(model, model_baseurl, query_string, conversation_history=[]):
 
         return reply, conversation_history
     except Exception as e:
+        # 重试后仍然失败时抛出异常，不再返回空回答，避免写入空白的 .LLM 文件
         logger.error(f"An unexpected error occurred: {e}")
-        return "", []
+        raise
+
+# 流式读取 Claude 的回复事件，start 的含义同 read_openai_stream
+def read_claude_stream(model, response, stream, start):
+    first_token_at = None
+    parts = []
+    tokens = 0
+    for event in response:
+        if event.type == 'content_block_delta' and getattr(event.delta, 'text', None):
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            parts.append(event.delta.text)
+            stream.feed(event.delta.text)
+        elif event.type == 'message_delta':
+            tokens = event.usage.output_tokens
+    end = time.monotonic()
+    reply = ''.join(parts)
+    record_stream_metrics(model, 'claude', start, first_token_at, end, tokens or misc.count_tokens(reply))
+    return reply
 
 @time_it_s
-def gen_by_Claude(model_name, model_baseurl, query_string, conversation_history=[]):
+def gen_by_Claude(model_name, model_baseurl, query_string, conversation_history=[], stream=None):
     try:
-        client = anthropic.Anthropic(
-            api_key = os.environ.get("WILDCARD_API_KEY"),
-            base_url = model_baseurl,
-        )
+        client = llm_clients.get_anthropic_client(model_baseurl, os.environ.get("WILDCARD_API_KEY"))
         messages = conversation_history + [
             {"role": "user", "content": f"{query_string}"}
         ]
-        mess = client.messages.create(
-            model=model_name,
-            max_tokens=1024,
-            messages=messages
-        )
-        reply = mess.content[0].text
+        params = {'base_url': model_baseurl, 'max_tokens': 1024}
+        reply = llm_cache.lookup(model_name, messages, params)
+        if reply is None:
+            def create():
+                if stream is not None:
+                    stream.reset()
+                    start = time.monotonic()
+                    raw = client.messages.with_raw_response.create(
+                        model=model_name,
+                        max_tokens=1024,
+                        messages=messages,
+                        stream=True
+                    )
+                    return read_claude_stream(model_name, raw.parse(), stream, start), raw.headers
+                raw = client.messages.with_raw_response.create(
+                    model=model_name,
+                    max_tokens=1024,
+                    messages=messages
+                )
+                return raw.parse().content[0].text, raw.headers
+            reply = rate_limit.call('claude', create, retry_exceptions=(anthropic.APIConnectionError,),
+                                    with_headers=True)
+            llm_cache.store(model_name, messages, reply, params)
         conversation_history.append(
             {"role": "assistant", "content": reply}
         )
 
         return reply, conversation_history
     except Exception as e:
+        # 重试后仍然失败时抛出异常，不再返回空回答，避免写入空白的 .LLM 文件
         logger.error(f"An unexpected error occurred: {e}")
-        return "", []
+        raise
 
-def gen_answer(query, references, model_name, model_baseurl, lang, answer_history=[]):
+# 用问题和前5条参考文献构建生成回答的提示词
+def build_answer_prompt(query, references, lang):
     if lang == 'Chinese':
         prompt = prompt_gen_cn
     else:
@@ -146,96 +283,240 @@ def gen_answer(query, references, model_name, model_baseurl, lang, answer_histor
     else:
         question = f"\nQuestion: {query}"
     prompt = f"{prompt}\n{question}"
-    
+    return prompt
+
+def gen_answer(query, references, model_name, model_baseurl, lang, answer_history=[], stream=None):
+    prompt = build_answer_prompt(query, references, lang)
     answer = ""
     history = []
     feature = ('gpt', 'moonshot', 'llama')
     if any(_ in model_name for _ in feature):
-        answer, history = gen_by_ChatGPT(model_name, model_baseurl, prompt, answer_history)
+        answer, history = gen_by_ChatGPT(model_name, model_baseurl, prompt, answer_history, stream)
     elif 'claude' in model_name:
-        answer, history = gen_by_Claude(model_name, model_baseurl, prompt, answer_history)
+        answer, history = gen_by_Claude(model_name, model_baseurl, prompt, answer_history, stream)
     else:
         logger.error("模型参数错误！")
     return answer, history
 
 # 提取每个语句中的数字引用，并找到其在references中的id，组成特定结构返回，没有引用的话则返回一个空数组
+# 可直接传入 references 列表；逐句调用时也可传入 answer_parser.build_ref_index(references) 建好的索引
 def extract_numbers_and_ref_ids(sentence, references):
-    # 使用正则表达式查找所有形如[数字]的模式
-    pattern = r'\[\d+\]'
-    matches = re.findall(pattern, sentence)
-    
-    # 提取数字并转换为整数
-    numbers = [int(match[1:-1]) for match in matches]
-    
-    # 根据提取的数字，从references中获取对应的ref_id
-    ref_ids = []
-    for number in numbers:
-        for ref in references:
-            if int(ref["idx"]) == number:
-                ref_ids.append({"idx": number, "ref_id": ref["ref_id"]})
-                break  # 找到匹配的ref_id后跳出循环
-    
-    return ref_ids
+    if isinstance(references, list):
+        references = build_ref_index(references)
+    return extract_citations(sentence, references)
 
-# 将LLM返回的answer逐句拆开，并组成特定结构
-def split_answer(answer:str, references:list, lang:str):
-    sentences_list = []
-    if lang == 'Chinese':
-        separator = "。"
-    else:
-        separator = "."
-    sentences = answer.split(separator)
-    cleaned_sentences = [sentence.strip('\n ') for sentence in sentences if sentence.strip('\n ') != '']
-    for index, sentence in enumerate(cleaned_sentences):
-        sentence_dict = {}
-        sentence_dict['sentence_id'] = misc.generate_random_code()
-        sentence_dict['idx'] = index + 1
-        sentence_dict['sentence_string'] = sentence
-        sentence_dict['references'] = extract_numbers_and_ref_ids(sentence, references)
-        sentences_list.append(sentence_dict)
-    return sentences_list
+# 将LLM返回的answer逐句拆开，并组成特定结构；同一组参考文献多次分句时可传入已建好的 parser
+def split_answer(answer:str, references:list, lang:str, parser=None):
+    return (parser or AnswerParser(references, lang)).split(answer)
 
-# 处理会话主体内容，将LLM生成的answers加入
-def handling_conversations(conversations: list, lang: str):
-    llm_answer_history = {key: [] for key in models}
+# 增量分句：流式生成时每收到一段文本就切出已完整的句子并提取引用，结果与 split_answer 一致
+class SentenceStream:
+    def __init__(self, references: list, lang: str, parser=None):
+        self.parser = parser or AnswerParser(references, lang)
+        self.reset()
+
+    def reset(self):
+        self.buffer = ""
+        self.text = ""
+        self.sentences = []
+
+    def _emit(self, sentences):
+        for sentence in sentences:
+            self.sentences.append(self.parser.sentence_dict(len(self.sentences) + 1, sentence))
+
+    def feed(self, delta: str):
+        self.text += delta
+        self.buffer += delta
+        sentences, end = self.parser.scan(self.buffer, final=False)
+        self.buffer = self.buffer[end:]
+        self._emit(sentences)
+
+    # 生成结束，处理最后一句；answer 与流式收到的内容不一致时（例如命中缓存）按完整回答重新分句
+    def finish(self, answer: str):
+        if answer != self.text:
+            self.reset()
+            self.buffer = answer or ""
+        sentences, _ = self.parser.scan(self.buffer)
+        self.buffer = ""
+        self._emit(sentences)
+        return self.sentences
+
+# 用一个模型依次生成会话中每一轮的回答，各轮之间共享该模型的对话历史
+def gen_model_answers(conversations: list, lang: str, model_name, model_baseurl):
+    answer_history = []
+    answer_list = []
     for conversation in conversations:
-        answer_list = []
         query = conversation['query']
         references = conversation['references']
-        for model_name, model_baseurl in models.items():
-            answer_dict = {}
-            answer_dict['answer_id'] = misc.generate_random_code()
-            answer, llm_answer_history[model_name] = gen_answer(query, references, model_name, model_baseurl, lang, llm_answer_history[model_name])
-            answer_dict['content'] = answer
-            answer_dict['model'] = model_name
-            answer_dict['sentences'] = split_answer(answer, references, lang)
-            answer_list.append(answer_dict)
-        conversation['answers'] = answer_list
-    return conversations
-
-
-def read_json_files(directory):    
+        stream = SentenceStream(references, lang) if stream_mode else None
+        answer, answer_history = gen_answer(query, references, model_name, model_baseurl, lang, answer_history, stream)
+        sentences = stream.finish(answer) if stream is not None else None
+        answer_list.append(build_answer_dict(misc.generate_random_code(), answer, model_name, sentences))
+    return answer_list
+
+# 回答的分句在整个文件的回答生成后由 split_conversation_answers 统一处理（流式模式下已增量分句）
+def build_answer_dict(answer_id, answer, model_name, sentences=None):
+    answer_dict = {}
+    answer_dict['answer_id'] = answer_id
+    answer_dict['content'] = answer
+    answer_dict['model'] = model_name
+    answer_dict['sentences'] = sentences
+    return answer_dict
+
+# 处理会话主体内容，将LLM生成的answers加入
+# 各模型的对话历史互不依赖，每个模型的多轮回答在线程池中并发生成，请求速率由各服务商的限流器控制
+def handling_conversations(conversations: list, lang: str):
+    futures = [_model_executor.submit(gen_model_answers, conversations, lang, model_name, model_baseurl)
+               for model_name, model_baseurl in models.items()]
+    model_answers = [future.result() for future in futures]
+    for i, conversation in enumerate(conversations):
+        conversation['answers'] = [answers[i] for answers in model_answers]
+    return split_conversation_answers(conversations, lang)
+
+def load_json_file(file_path):
+    # 打开并读取json文件
+    with open(file_path, 'r', encoding='utf-8') as f:
+        try:
+            # 将文件内容转换为字典
+            return json.load(f)
+        except json.JSONDecodeError as e:
+            logger.error(f"Error decoding JSON from file {file_path}: {e}")
+            return None
+
+def save_llm_file(data, file_path):
+    misc.save_json_file(data, f"{file_path}.LLM", "multi", 'w')
+    logger.info(f"保存文件 {file_path}.LLM 成功！")
+
+def handling_file(file_path):
+    data = load_json_file(file_path)
+    if data is None:
+        return
+    lang = data['conversations']['lang']
+    contents = data['conversations']['contents']
+    data['conversations']['contents'] = handling_conversations(contents, lang)
+    save_llm_file(data, file_path)
+
+def list_json_files(directory):
+    file_paths = []
     for root, _, files in os.walk(directory):
         for file in files:
             # 检查文件扩展名是否为.json
             if file.endswith('.json'):
                 # 构造完整的文件路径
-                file_path = os.path.join(root, file)
-                # 打开并读取json文件
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    try:
-                        # 将文件内容转换为字典
-                        data = json.load(f)
-                        lang = data['conversations']['lang']
-                        contents = data['conversations']['contents']
-                        data['conversations']['contents'] = handling_conversations(contents, lang)
-                        misc.save_json_file(data, f"{file_path}.LLM", "multi", 'w')
-                        logger.info(f"保存文件 {file_path}.LLM 成功！")
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error decoding JSON from file {file_path}: {e}")
+                file_paths.append(os.path.join(root, file))
+    return file_paths
+
+def log_rate_limit_stats():
+    for provider in sorted({model_provider(model_name) for model_name in models}):
+        logger.info(f"{provider} 限流统计：{rate_limit.get_limiter(provider).stats()}")
+
+# 多个文件并行处理
+def read_json_files(directory):
+    file_paths = list_json_files(directory)
+    with ThreadPoolExecutor(max_workers=file_workers) as executor:
+        futures = {executor.submit(handling_file, file_path): file_path for file_path in file_paths}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # 有模型生成失败时不写入该文件的 .LLM 结果，下次运行时重新生成
+                logger.error(f"处理文件 {futures[future]} 时发生错误，未保存结果：{e}")
+    log_rate_limit_stats()
+
+# 批量模式：同一轮次（第 r 轮）所有文件、所有批量模型的请求写成一个批量任务提交，
+# 按 answer_id（custom_id）合并结果后再提交下一轮；不支持批量接口的模型仍然同步生成
+def gen_answers_batch(datas: dict, batch_models: dict):
+    chains = []  # 每个 (文件, 模型) 一条多轮回答链
+    for file_path, data in datas.items():
+        for model_name, model_baseurl in batch_models.items():
+            chains.append({'file_path': file_path, 'model': model_name, 'baseurl': model_baseurl,
+                           'lang': data['conversations']['lang'], 'contents': data['conversations']['contents'],
+                           'history': [], 'answers': [], 'error': None})
+    rounds = max((len(chain['contents']) for chain in chains), default=0)
+    for r in range(rounds):
+        active = [chain for chain in chains if chain['error'] is None and r < len(chain['contents'])]
+        groups = {}
+        for chain in active:
+            conversation = chain['contents'][r]
+            prompt = build_answer_prompt(conversation['query'], conversation['references'], chain['lang'])
+            chain['prompt'] = prompt
+            chain['messages'] = chain['history'] + [{"role": "user", "content": f"{prompt}"}]
+            chain['answer_id'] = misc.generate_random_code()
+            chain['reply'] = llm_cache.lookup(chain['model'], chain['messages'], {'base_url': chain['baseurl']})
+            if chain['reply'] is None:
+                groups.setdefault((chain['baseurl'], model_provider(chain['model'])), []).append(chain)
+
+        for (baseurl, provider), group in groups.items():
+            client = llm_clients.get_openai_client(baseurl, provider_api_key(provider))
+            requests = [(chain['answer_id'], chain['model'], chain['messages']) for chain in group]
+            try:
+                replies = llm_batch.run_batch(client, provider, requests, f"{provider}_{int(time.time())}_round{r + 1}")
+            except Exception as e:
+                logger.error(f"批量任务执行失败，改为同步生成：{e}")
+                replies = {}
+            for chain in group:
+                chain['reply'] = replies.get(chain['answer_id'])
+                if chain['reply'] is not None:
+                    llm_cache.store(chain['model'], chain['messages'], chain['reply'], {'base_url': chain['baseurl']})
+
+        for chain in active:
+            try:
+                if chain['reply'] is None:
+                    # 批量任务中失败的请求同步重新生成
+                    chain['reply'], _ = gen_by_ChatGPT(chain['model'], chain['baseurl'], chain['prompt'],
+                                                       list(chain['history']))
+                chain['history'].append({"role": "assistant", "content": chain['reply']})
+                chain['answers'].append(build_answer_dict(chain['answer_id'], chain['reply'], chain['model']))
+            except Exception as e:
+                chain['error'] = e
+    return {(chain['file_path'], chain['model']): chain for chain in chains}
+
+def read_json_files_batch(directory):
+    datas = {}
+    for file_path in list_json_files(directory):
+        data = load_json_file(file_path)
+        if data is not None:
+            datas[file_path] = data
+    batch_models = {name: url for name, url in models.items() if model_provider(name) in batch_providers}
+    if not batch_models:
+        # models 中没有支持批量接口的模型时，批量模式默认使用 openai_model
+        batch_models = {openai_model: openai_baseurl}
+        logger.info(f"models 中没有支持批量接口的模型，批量生成使用 {openai_model}")
+    sync_models = {name: url for name, url in models.items() if name not in batch_models}
+    # 不支持批量接口的模型在后台同步生成，与批量任务同时进行
+    sync_futures = {(file_path, model_name): _model_executor.submit(
+                        gen_model_answers, data['conversations']['contents'], data['conversations']['lang'],
+                        model_name, model_baseurl)
+                    for file_path, data in datas.items() for model_name, model_baseurl in sync_models.items()}
+    batch_chains = gen_answers_batch(datas, batch_models)
+
+    for file_path, data in datas.items():
+        try:
+            model_answers = []
+            for model_name in {**models, **batch_models}:
+                if model_name in batch_models:
+                    chain = batch_chains[(file_path, model_name)]
+                    if chain['error'] is not None:
+                        raise chain['error']
+                    model_answers.append(chain['answers'])
+                else:
+                    model_answers.append(sync_futures[(file_path, model_name)].result())
+            for i, conversation in enumerate(data['conversations']['contents']):
+                conversation['answers'] = [answers[i] for answers in model_answers]
+            split_conversation_answers(data['conversations']['contents'], data['conversations']['lang'])
+            save_llm_file(data, file_path)
+        except Exception as e:
+            logger.error(f"处理文件 {file_path} 时发生错误，未保存结果：{e}")
+    log_rate_limit_stats()
 
 def main():
-    read_json_files(data_dir)
+    global stream_mode
+    if len(sys.argv) > 1 and sys.argv[1] == 'stream':
+        stream_mode = True
+    if batch_mode or (len(sys.argv) > 1 and sys.argv[1] == 'batch'):
+        read_json_files_batch(data_dir)
+    else:
+        read_json_files(data_dir)
 
 if __name__ == "__main__":
     misc.setup_logging()
@@ -4,18 +4,27 @@ import json
 import string
 import random
 import timeit
-from functools import wraps
+from functools import wraps, lru_cache
 import logging
 import logging.config
 import yaml
 import inspect
+import threading
 import tiktoken
-from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-import requests
+import httpx
+import fetcher
+import downloader
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# JSONL 写入缓冲区大小
+jsonl_buffer_size = 1024 * 1024
+
 def setup_logging(default_path='logging_config.yaml'):
     path = os.path.join(os.path.dirname(__file__), default_path)
     if os.path.exists(path):
@@ -70,162 +79,168 @@ def generate_random_code(length=10):
     
     return random_code
 
+# 将数据序列化为 JSON 字符串的字节，默认格式与原来的 json.dumps(ensure_ascii=False) 相同（", " 与 ": " 分隔）
+# fast 为 True 且安装了 orjson 时使用 orjson 序列化，输出为紧凑格式（无空格）；
+# orjson 无法序列化的数据（如超过 64 位的整数）仍使用 json 格式
+def dumps_json_bytes(data, indent=None, fast=False):
+    if fast and indent is None and orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(data, ensure_ascii=False, indent=indent).encode('utf-8')
+
+# 判断 JSONL 文件能否使用 orjson 的紧凑格式继续写入：文件为空，或第一行就是 orjson 格式，
+# 避免在原有 json 格式的文件中追加另一种格式的行
+def can_write_fast(file_path):
+    if orjson is None:
+        return False
+    try:
+        with open(file_path, 'rb') as file:
+            first = file.readline().rstrip(b'\r\n')
+    except FileNotFoundError:
+        return True
+    if not first:
+        return True
+    try:
+        return orjson.dumps(orjson.loads(first), option=orjson.OPT_NON_STR_KEYS) == first
+    except (orjson.JSONDecodeError, TypeError):
+        return False
+
+# 解析一行 JSON，安装了 orjson 时使用 orjson 加速
+def loads_json_line(line):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+# 流式 JSONL 写入器：文件只打开一次，按缓冲区批量落盘，关闭时可选 fsync
+class JsonlWriter:
+    def __init__(self, file_path, file_mode='a', buffer_size=jsonl_buffer_size, fast=False, fsync=False, indent=None):
+        self.file_path = file_path
+        # fast 时只有新文件（或原本就是 orjson 格式的文件）才使用 orjson，同一文件中的行格式保持一致
+        self.fast = fast and (file_mode.startswith('w') or can_write_fast(file_path))
+        self.fsync = fsync
+        self.indent = indent
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(file_path, file_mode.replace('b', '') + 'b', buffering=buffer_size)
+
+    # 写入一条记录，一条记录占一行（indent 不为 None 时为多行）
+    def write(self, data):
+        self.write_line(dumps_json_bytes(data, self.indent, self.fast))
+
+    # 写入一行已经序列化好的内容，用于不需要重新序列化的场景
+    def write_line(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+
+    # 写入原始字节，不计入记录数
+    def write_bytes(self, data):
+        with self._lock:
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 # 将输入的 dict 数据保存到 json 文件中
 def save_json_file(data_dict, file_path, mode='single', file_mode='a'):
     try:
-        # 如果文件不存在，则创建一个空文件
-        if not os.path.exists(file_path):
-            open(file_path, 'w').close()
-
-        # 将字典转换为JSON格式的字符串
-        if mode == 'single':
-            json_string = json.dumps(data_dict, ensure_ascii=False) + '\n'
-        else:
-            json_string = json.dumps(data_dict, ensure_ascii=False, indent=4) + '\n'
-
-        # 追加JSON字符串到文件
-        with open(file_path, file_mode, encoding='utf-8') as file:
-            file.write(json_string)
+        # single 模式一条记录占一行，否则以缩进格式写入
+        indent = None if mode == 'single' else 4
+        with JsonlWriter(file_path, file_mode, indent=indent) as writer:
+            writer.write(data_dict)
     except IOError as e:
         logger.error(f"An IOError occurred: {e}")
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
 
+# 获取OpenAI的tokenizer，同一模型只加载一次
+@lru_cache(maxsize=None)
+def get_token_encoding(model='gpt-3.5-turbo'):
+    return tiktoken.encoding_for_model(model)
+
+# 原子地保存 json 文件：先写入同目录下的临时文件并 fsync，再替换目标文件，避免留下写了一半的文件
+def atomic_save_json_file(data_dict, file_path, mode='single'):
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        indent = None if mode == 'single' else 4
+        with JsonlWriter(tmp_path, 'w', indent=indent, fsync=True) as writer:
+            writer.write(data_dict)
+        os.replace(tmp_path, file_path)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 # 使用OpenAI的tokenizer计算token数量
 def calculate_token_count(text, logger, model='gpt-3.5-turbo'):
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
-    token_count = len(tokens)
+    token_count = count_tokens(text, model)
     word_count = len(text)
     logger.info(f"Token count: {token_count}\nOriginal Text Count: {word_count}")
     return token_count
 
-# 下载文件
-def download_file(url, num_threads=5, filename='download.pdf', is_single=False, chunk_size=1024*1024):
-    try:
-        file_size = get_file_size(url)
-        if not is_single and file_size is not None:
-            download_pdf_multi_thread(url, num_threads, filename, file_size)
-        else:
-            download_pdf_chunked(url, num_threads, filename, chunk_size)
-    except Exception as e:
-        logger.info(f"发生错误: {e}")
-        logger.info("将使用单线程下载方式")
-        download_file_single_thread(url, filename)
-
-
-# 定义一个下载PDF部分的函数
-def download_chunk(url, start, end, filename):
-    headers = {'Range': f'bytes={start}-{end}'}
-    with requests.get(url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(filename, 'r+b') as f:
-            f.seek(start)
-            f.write(r.content)
-
-def download_pdf_chunked(url, num_threads, filename, chunk_size):
-    with open(filename, 'wb') as f:
-        pass  # 创建空文件
-
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        offset = 0
-        while True:
-            futures = []
-            for _ in range(num_threads):
-                future = executor.submit(download_chunk_no_size, url, offset, offset + chunk_size - 1, filename)
-                futures.append(future)
-                offset += chunk_size
-
-            completed = False
-            for future in futures:
-                result = future.result()
-                if not result:
-                    completed = True
-                    break
-
-            if completed:
-                break
-
-def download_chunk_no_size(url, start, end, filename):
-    headers = {'Range': f'bytes={start}-{end}'}
-    with requests.get(url, headers=headers, stream=True) as r:
-        if r.status_code == 416:  # 请求范围不满足
-            return False
-        r.raise_for_status()
-        with open(filename, 'r+b') as f:
-            f.seek(start)
-            f.write(r.content)
-    return True
-
-# 计算文件总大小
-def get_file_size(url):
-    try:
-        response = requests.head(url)
-        response.raise_for_status()
-        return int(response.headers.get('Content-Length', 0))
-    except:
-        return None
+# 计算token数量，不输出日志
+def count_tokens(text, model='gpt-3.5-turbo'):
+    return len(get_token_encoding(model).encode(text, disallowed_special=()))
 
-# 多线程下载函数
-@time_it_s
-def download_pdf_multi_thread(url, num_threads, filename, file_size):
-    part_size = file_size // num_threads
-    # 创建一个空的文件
-    with open(filename, 'wb') as f:
-        f.truncate(file_size)
-    
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        futures = []
-        with tqdm(total=file_size, unit='B', unit_scale=True, desc=filename) as pbar:
-            for i in range(num_threads):
-                start = i * part_size
-                end = (i + 1) * part_size - 1 if i < num_threads - 1 else file_size - 1
-                future = executor.submit(download_chunk_with_progress, url, start, end, filename, pbar)
-                futures.append(future)
-            
-            for future in futures:
-                future.result()  # 等待每个线程完成
-
-def download_chunk_with_progress(url, start, end, filename, pbar):
-    headers = {'Range': f'bytes={start}-{end}'}
-    with requests.get(url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(filename, 'r+b') as f:
-            f.seek(start)
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    pbar.update(len(chunk))
-    return True
-
-
-# 单线程下载文件的函数
+# 按token数将文本切分为若干块，优先在段落边界切分，单个段落超长时按token硬切
+def split_text_by_tokens(text, chunk_tokens, model='gpt-3.5-turbo'):
+    encoding = get_token_encoding(model)
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in text.split('\n'):
+        if not paragraph.strip():
+            continue
+        tokens = encoding.encode(paragraph, disallowed_special=())
+        if len(tokens) > chunk_tokens:
+            if current:
+                chunks.append('\n'.join(current))
+                current, current_tokens = [], 0
+            for start in range(0, len(tokens), chunk_tokens):
+                chunks.append(encoding.decode(tokens[start:start + chunk_tokens]))
+            continue
+        if current_tokens + len(tokens) > chunk_tokens and current:
+            chunks.append('\n'.join(current))
+            current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += len(tokens)
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+# 下载文件，由 downloader 统一处理：支持 Range 时按 num_threads 分段并行下载并支持断点续传，否则单连接流式下载
+# chunk_size 为每个分段的最小字节数
 @time_it_s
-def download_file_single_thread(url, filename='output.pdf'):
+def download_file(url, num_threads=5, filename='download.pdf', is_single=False, chunk_size=1024*1024):
     try:
-        # 发送GET请求获取文件内容
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # 如果请求不成功则抛出异常
-        
-        # 获取文件总大小
-        file_size = int(response.headers.get('Content-Length', 0))
-        if file_size == 0:
-            logger.warning("警告：无法获取文件大小，进度条可能无法正确显示。")
-        
-        # 打开文件准备写入
-        with open(filename, 'wb') as file, tqdm(
-            desc=filename,
-            total=file_size,
-            unit='iB',
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as progress_bar:
-            for data in response.iter_content(chunk_size=1024):
-                size = file.write(data)
-                progress_bar.update(size)
-        
-        logger.info(f"文件 {filename} 下载完成")
-    except requests.RequestException as e:
+        with tqdm(desc=filename, unit='iB', unit_scale=True, unit_divisor=1024) as progress_bar:
+            result = downloader.download(url, filename, parts=1 if is_single else num_threads,
+                                         min_part=chunk_size, progress=progress_bar.update)
+        logger.info(f"文件 {filename} 下载完成，大小：{result.size}字节")
+    except (httpx.HTTPError, fetcher.FetchError) as e:
         logger.info(f"下载失败: {e}")
     except IOError as e:
         logger.info(f"写入文件时出错: {e}")
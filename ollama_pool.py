@@ -0,0 +1,107 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+import ollama
+
+logger = logging.getLogger(__name__)
+
+# 每个 Ollama 服务同时处理的请求数，应与服务端的 OLLAMA_NUM_PARALLEL 保持一致
+num_parallel = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+report_interval = 60  # 定期输出队列深度与延迟统计的间隔（秒）
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# 从 OLLAMA_HTTP 读取服务地址，多个地址以逗号分隔；未设置时使用 ollama 的默认地址
+def parse_hosts(value=None):
+    value = value if value is not None else os.environ.get('OLLAMA_HTTP', '')
+    hosts = [host.strip() for host in value.split(',') if host.strip()]
+    return hosts or [None]
+
+# 长期复用的 Ollama 客户端池：每个服务一个客户端，请求分配给当前负载最小的服务，
+# 所有服务都满载时在队列中等待
+class OllamaPool:
+    def __init__(self, hosts, num_parallel=num_parallel):
+        self.num_parallel = num_parallel
+        self._hosts = [{'host': host, 'client': ollama.Client(host=host), 'active': 0, 'done': 0, 'errors': 0}
+                       for host in hosts]
+        self._cond = threading.Condition()
+        self._waiting = 0
+        self._latencies = deque(maxlen=1000)
+        self._last_report = time.monotonic()
+
+    def _acquire(self):
+        with self._cond:
+            self._waiting += 1
+            while True:
+                slot = min(self._hosts, key=lambda h: h['active'])
+                if slot['active'] < self.num_parallel:
+                    break
+                self._cond.wait()
+            self._waiting -= 1
+            slot['active'] += 1
+            return slot
+
+    def _release(self, slot, latency, failed):
+        with self._cond:
+            slot['active'] -= 1
+            slot['done'] += 1
+            if failed:
+                slot['errors'] += 1
+            self._latencies.append(latency)
+            self._cond.notify()
+
+    def chat(self, model, messages, **kwargs):
+        slot = self._acquire()
+        start = time.monotonic()
+        failed = True
+        try:
+            response = slot['client'].chat(model=model, messages=messages, **kwargs)
+            failed = False
+            return response
+        finally:
+            self._release(slot, time.monotonic() - start, failed)
+            self._maybe_report()
+
+    # 当前排队数、执行中的请求数、各服务的完成数，以及最近请求的延迟分布（毫秒）
+    def stats(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+            hosts = {str(h['host']): {'active': h['active'], 'done': h['done'], 'errors': h['errors']}
+                     for h in self._hosts}
+            waiting = self._waiting
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+        return {
+            'queue_depth': waiting,
+            'in_flight': sum(h['active'] for h in hosts.values()),
+            'hosts': hosts,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'max': percentile(1.0)},
+        }
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        with self._cond:
+            if now - self._last_report < report_interval:
+                return
+            self._last_report = now
+        self.report()
+
+    def report(self):
+        s = self.stats()
+        logger.info(f"Ollama 队列深度: {s['queue_depth']}, 执行中: {s['in_flight']}, "
+                    f"延迟 p50/p95/max: {s['latency_ms']['p50']:.0f}/{s['latency_ms']['p95']:.0f}/{s['latency_ms']['max']:.0f} ms, "
+                    f"各服务: {s['hosts']}")
+
+# 获取进程内共享的客户端池
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = OllamaPool(parse_hosts())
+    return _pool
+
+def chat(model, messages, **kwargs):
+    return get_pool().chat(model, messages, **kwargs)
@@ -0,0 +1,139 @@
+import os
+import mmap
+import asyncio
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ProcessPoolExecutor
+import pymupdf
+import misc
+
+logger = logging.getLogger(__name__)
+
+# PDF 文本抽取配置：按页范围拆分到进程池中并行抽取，超过页数或字数预算后不再继续
+extract_workers = max(1, min(8, os.cpu_count() or 1))
+pages_per_task = 16      # 每个任务抽取的页数
+max_pages = 200          # 每个 PDF 最多抽取的页数
+max_chars = 200 * 1000   # 每个 PDF 最多抽取的字符数，超出部分截断
+worker_open_docs = 4     # 每个子进程保持打开的文档数，同一 PDF 的多个页范围任务只解析一次
+
+_executor = None
+_executor_lock = threading.Lock()
+_worker_docs = OrderedDict()  # 子进程中已打开的文档：(路径, inode, 修改时间, 大小) -> (ExitStack, 文档)
+
+# 子进程初始化：spawn 出的进程不继承父进程的日志配置，需要重新加载
+def init_worker():
+    misc.setup_logging()
+
+# 获取进程内共享的抽取进程池；调用方是多线程程序，使用 spawn 避免 fork 时复制锁状态
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=extract_workers,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker)
+    return _executor
+
+# 以内存映射的方式打开 PDF，不把整个文件读入内存
+@contextmanager
+def open_pdf(file_path):
+    with open(file_path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(buffer)
+        doc = None
+        try:
+            doc = pymupdf.open(stream=view, filetype='pdf')
+            yield doc
+        finally:
+            if doc is not None:
+                doc.close()
+            view.release()
+            buffer.close()
+
+# 获取子进程中已打开的文档，没有时打开并解析一次；文件被替换后（inode、修改时间或大小变化）重新打开
+# 按最近使用保留 worker_open_docs 个文档，超出时关闭最久未用的
+def worker_doc(file_path):
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    entry = _worker_docs.get(key)
+    if entry is not None:
+        _worker_docs.move_to_end(key)
+        return entry[1]
+    stack = ExitStack()
+    doc = stack.enter_context(open_pdf(file_path))
+    _worker_docs[key] = (stack, doc)
+    while len(_worker_docs) > worker_open_docs:
+        _, (old_stack, _) = _worker_docs.popitem(last=False)
+        old_stack.close()
+    return doc
+
+# 抽取 [start, stop) 页的文本，在子进程中运行；单页失败时跳过该页
+def extract_pages(file_path, start, stop, limit=max_chars):
+    texts = []
+    size = 0
+    doc = worker_doc(file_path)
+    for number in range(start, min(stop, doc.page_count)):
+        try:
+            text = doc[number].get_text()
+        except Exception as e:
+            logger.warning(f"无法读取第 {number} 页: {str(e)}")
+            continue
+        texts.append(text)
+        size += len(text) + 1
+        if size >= limit:
+            break
+    return "\n".join(texts)
+
+def page_count(file_path):
+    with open_pdf(file_path) as doc:
+        return doc.page_count
+
+# 按页范围拆分抽取任务，受 max_pages 限制
+def page_ranges(count, pages=max_pages, step=pages_per_task):
+    count = min(count, pages)
+    return [(start, min(start + step, count)) for start in range(0, count, step)]
+
+# 按页顺序合并各任务的结果，累计字数超过预算后取消剩余任务并截断
+def join_pages(parts, futures, chars):
+    texts = []
+    size = 0
+    for i, part in enumerate(parts):
+        texts.append(part)
+        size += len(part) + 1
+        if size >= chars:
+            for future in futures[i + 1:]:
+                future.cancel()
+            break
+    text = "\n".join(texts)[:chars].strip()
+    if not text:
+        logger.warning("PDF文件似乎是空的或无法提取文本")
+    return text
+
+# 并行抽取 PDF 文本，返回最多 chars 个字符
+def extract_text(file_path, pages=max_pages, chars=max_chars):
+    executor = get_executor()
+    futures = [executor.submit(extract_pages, file_path, start, stop, chars)
+               for start, stop in page_ranges(page_count(file_path), pages)]
+    return join_pages((future.result() for future in futures), futures, chars)
+
+# extract_text 的异步版本，供后台事件循环中的抓取协程使用，等待时不阻塞事件循环
+async def aextract_text(file_path, pages=max_pages, chars=max_chars):
+    executor = get_executor()
+    count = await asyncio.to_thread(page_count, file_path)
+    futures = [asyncio.wrap_future(executor.submit(extract_pages, file_path, start, stop, chars))
+               for start, stop in page_ranges(count, pages)]
+    parts = []
+    size = 0
+    try:
+        for future in futures:
+            parts.append(await future)
+            size += len(parts[-1]) + 1
+            if size >= chars:
+                break
+    finally:
+        for future in futures:
+            future.cancel()
+    return join_pages(parts, [], chars)
@@ -0,0 +1,248 @@
+import re
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 各服务商的限流配置：(每分钟请求数, 同时进行的请求数上限)
+# 实际的请求速率会按响应中的限流头调整，并发数从 initial_concurrency 开始按 AIMD 自适应增减
+provider_limits = {
+    'openai': (500, 32),
+    'claude': (50, 8),
+    'moonshot': (60, 8),
+    'perplexity': (50, 8),
+    'wildcard': (60, 8),
+    'serpapi': (100, 8),
+    'ollama': (60000, 256),
+}
+default_limit = (60, 4)
+initial_concurrency = 2
+# 本地服务不做 AIMD 调整，并发数固定为上限，实际的并发由 ollama_pool 按服务数和 OLLAMA_NUM_PARALLEL 控制
+local_providers = ('ollama',)
+max_attempts = 6        # 每次请求最多尝试的次数
+base_delay = 1.0        # 指数退避的初始等待时间（秒）
+max_delay = 60.0        # 单次退避的最长等待时间（秒）
+retry_status = (408, 409, 429, 500, 502, 503, 504, 529)
+throttle_status = (429, 529)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# 服务商要求限流或暂时不可用时抛出，retry_after 为建议的等待时间（秒）
+class RetryableError(Exception):
+    def __init__(self, message, status_code=None, retry_after=None, throttled=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+# 解析 "1s"、"6m0s"、"20ms" 或秒数形式的时长
+def parse_duration(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for number, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        matched = True
+        total += float(number) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total if matched else None
+
+# 解析重置时间：时长、RFC 3339 时间或 HTTP 日期，返回距现在的秒数
+def parse_reset(value):
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return seconds
+    try:
+        if 'T' in value:
+            reset = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        else:
+            reset = parsedate_to_datetime(value)
+        return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _header(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+# 从响应头中读取限流信息：(每分钟请求数上限, 剩余请求数, 重置等待秒数, Retry-After 秒数)
+# 兼容 OpenAI 兼容接口的 x-ratelimit-* 和 Anthropic 的 anthropic-ratelimit-* 头
+def parse_rate_headers(headers):
+    if not headers:
+        return None, None, None, None
+    limit = _header(headers, 'x-ratelimit-limit-requests', 'anthropic-ratelimit-requests-limit', 'x-ratelimit-limit')
+    remaining = _header(headers, 'x-ratelimit-remaining-requests', 'anthropic-ratelimit-requests-remaining',
+                        'x-ratelimit-remaining')
+    reset = _header(headers, 'x-ratelimit-reset-requests', 'anthropic-ratelimit-requests-reset', 'x-ratelimit-reset')
+    retry_after = parse_duration(_header(headers, 'retry-after'))
+    try:
+        limit = int(limit) if limit is not None else None
+        remaining = int(remaining) if remaining is not None else None
+    except ValueError:
+        limit = remaining = None
+    return limit, remaining, parse_reset(reset) if reset is not None else None, retry_after
+
+# 根据异常判断是否可以重试，返回 (是否重试, 是否被限流, 状态码, 响应头)
+def classify_error(e, retry_exceptions=()):
+    if isinstance(e, RetryableError):
+        return True, e.throttled, e.status_code, None
+    response = getattr(e, 'response', None)
+    status = getattr(e, 'status_code', None) or getattr(response, 'status_code', None)
+    headers = getattr(response, 'headers', None)
+    if status is not None:
+        return status in retry_status, status in throttle_status, status, headers
+    if isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError)) or isinstance(e, retry_exceptions):
+        return True, False, None, None
+    return False, False, None, None
+
+# 自适应限流器：令牌桶控制请求速率，按响应中的限流头校准；
+# 并发数按 AIMD 调整，连续成功时逐步增加，遇到限流时减半（adaptive 为 False 时固定为上限），线程安全
+class RateLimiter:
+    def __init__(self, name, rpm, max_concurrency, adaptive=True):
+        self.name = name
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, float(max_concurrency))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.max_concurrency = max_concurrency
+        self.adaptive = adaptive
+        self.concurrency = float(min(initial_concurrency, max_concurrency) if adaptive else max_concurrency)
+        self.active = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 等待并发名额和令牌
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.active < int(self.concurrency) and now >= self.blocked_until:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.active += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                elif now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    wait = None  # 等待其他请求释放并发名额
+                self._cond.wait(wait)
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    # 按响应头校准请求速率；剩余请求数为 0 或要求 Retry-After 时暂停发送，直到重置
+    def observe(self, headers):
+        limit, remaining, reset, retry_after = parse_rate_headers(headers)
+        with self._cond:
+            now = time.monotonic()
+            if limit:
+                self.rate = limit / 60.0
+            if remaining is not None and remaining <= 0 and reset:
+                self.blocked_until = max(self.blocked_until, now + reset)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    # 加性增：每完成约一个并发窗口的成功请求，并发数加 1
+    def on_success(self, headers=None):
+        if headers is not None:
+            self.observe(headers)
+        with self._cond:
+            self.successes += 1
+            if self.adaptive and self.concurrency < self.max_concurrency:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+                self._cond.notify_all()
+
+    # 乘性减：遇到限流时并发数减半，并暂停到服务商要求的时间之后
+    def on_throttle(self, headers=None, retry_after=None):
+        if headers is not None:
+            self.observe(headers)
+        with self._cond:
+            now = time.monotonic()
+            self.throttles += 1
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            # 同一批并发请求同时被限流时只减半一次
+            if not self.adaptive or now - self.last_decrease < 1.0:
+                return
+            self.last_decrease = now
+            self.concurrency = max(1.0, self.concurrency / 2)
+        logger.info(f"{self.name} 触发限流，并发数降为 {int(self.concurrency)}")
+
+    def on_retry(self):
+        with self._cond:
+            self.retries += 1
+
+    def stats(self):
+        with self._cond:
+            return {'concurrency': int(self.concurrency), 'active': self.active, 'rpm': round(self.rate * 60),
+                    'successes': self.successes, 'throttles': self.throttles, 'retries': self.retries}
+
+# 获取服务商对应的限流器，同一进程内共享
+def get_limiter(provider):
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            rpm, concurrency = provider_limits.get(provider, default_limit)
+            limiter = RateLimiter(provider, rpm, concurrency, adaptive=provider not in local_providers)
+            _limiters[provider] = limiter
+    return limiter
+
+# 带抖动的指数退避等待时间
+def backoff_delay(attempt, retry_after=None):
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    delay = random.uniform(delay / 2, delay)
+    return max(delay, retry_after or 0)
+
+# 在服务商的限流器控制下调用 func，限流或临时错误时按指数退避重试，超过次数后抛出最后一次的异常
+# func 可以返回 (结果, 响应头)，用于按限流头校准；返回其他值时视为没有响应头
+def call(provider, func, *args, retry_exceptions=(), with_headers=False, **kwargs):
+    limiter = get_limiter(provider)
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            retry, throttled, status, headers = classify_error(e, retry_exceptions)
+            retry_after = getattr(e, 'retry_after', None) or parse_rate_headers(headers)[3]
+            if throttled:
+                limiter.on_throttle(headers, retry_after)
+            if not retry or attempt == max_attempts - 1:
+                raise
+            delay = backoff_delay(attempt, retry_after)
+            limiter.on_retry()
+            logger.warning(f"{provider} 请求失败（{status or type(e).__name__}），{delay:.1f}秒后第{attempt + 1}次重试：{e}")
+        else:
+            if with_headers:
+                result, headers = result
+                limiter.on_success(headers)
+            else:
+                limiter.on_success()
+            return result
+        finally:
+            limiter.release()
+        time.sleep(delay)
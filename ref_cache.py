@@ -0,0 +1,294 @@
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import logging
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import fetcher
+import downloader
+
+logger = logging.getLogger(__name__)
+
+# 参考文献抓取缓存配置，可被多个进程共享
+cache_dir = "ref_cache"
+max_cache_bytes = 20 * 1024 * 1024 * 1024  # 缓存总大小上限，超过后按最近最少使用淘汰
+max_object_bytes = 200 * 1024 * 1024       # 单个响应体大小上限
+fresh_seconds = 24 * 3600                  # 在此时间内抓取的缓存直接使用，超过后向服务器重新验证
+evict_target = 0.9                         # 超过上限时一次淘汰到上限的这个比例，避免每次写入都触发淘汰
+evict_grace_seconds = 600                  # 最近访问过的对象可能正被其他进程读取，淘汰时跳过
+stale_tmp_seconds = 24 * 3600              # tmp 目录中超过这个时间未修改的文件（中断的下载、续传状态）启动时清理
+
+_cache = None
+_cache_lock = threading.Lock()
+_downloads = {}   # 正在下载入库的大文件，同一 url 只下载一次
+
+# 规范化 url 作为缓存键：协议和主机小写、去掉默认端口和片段、去掉 utm 跟踪参数并对查询参数排序
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == 'http' and port == 80) or (scheme == 'https' and port == 443)):
+        host = f"{host}:{port}"
+    path = parts.path or "/"
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith('utm_')]
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ""))
+
+# 缓存条目，响应体以内容哈希命名存放在 objects 目录下
+# afetch 返回的条目处于占用状态，淘汰时不会删除其对象文件；读取完后调用 release 或使用 with 语句
+class CacheEntry:
+    def __init__(self, url, digest, size, path, content_type=None, cache=None):
+        self.url = url
+        self.digest = digest
+        self.size = size
+        self.path = path
+        self.content_type = content_type
+        self._cache = cache
+
+    def release(self):
+        if self._cache is not None:
+            self._cache.unpin(self.digest)
+            self._cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def read_bytes(self):
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def read_text(self):
+        return fetcher.decode_content(self.read_bytes())
+
+# 以 url 为键、内容哈希寻址的磁盘缓存，索引保存在 SQLite 中
+class RefCache:
+    def __init__(self, root=cache_dir, max_bytes=max_cache_bytes, fresh_seconds=fresh_seconds):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.objects_dir = os.path.join(root, "objects")
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pinned = Counter()    # 本进程中正在被读取的对象
+        self._total = None          # 缓存总大小的估计值，首次写入时从索引中统计
+        self._evict_after = 0.0     # 没有可淘汰的对象时，暂缓到此时间再尝试
+        self.clean_tmp()
+        self._db = sqlite3.connect(os.path.join(root, "index.db"), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            content_type TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self._db.commit()
+
+    # 清理 tmp 目录中长时间未修改的文件，包括放弃的下载留下的 .part/.part.json
+    # 只清理较旧的文件，避免删除其他进程正在下载的内容
+    def clean_tmp(self, max_age=stale_tmp_seconds):
+        expired = time.time() - max_age
+        removed = 0
+        for entry in os.scandir(self.tmp_dir):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info(f"清理了{removed}个过期的临时文件")
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def pin(self, digest):
+        self._pinned[digest] += 1
+
+    def unpin(self, digest):
+        with self._lock:
+            self._pinned[digest] -= 1
+            if self._pinned[digest] <= 0:
+                del self._pinned[digest]
+
+    # 查找缓存条目，返回 (已占用的 CacheEntry, 行数据)，对象文件已丢失时视为未命中
+    # SQLite 读写会阻塞，异步代码中需放到线程中调用
+    def lookup(self, url):
+        key = normalize_url(url)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, size, content_type, etag, last_modified, fetched_at FROM entries WHERE url = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None, None
+            path = self.object_path(row[0])
+            if not os.path.exists(path):
+                return None, None
+            self.pin(row[0])
+        return CacheEntry(url, row[0], row[1], path, row[2], self), row
+
+    def touch(self, url, refetched=False):
+        now = time.time()
+        with self._lock:
+            if refetched:
+                self._db.execute("UPDATE entries SET accessed_at = ?, fetched_at = ? WHERE url = ?",
+                                 (now, now, normalize_url(url)))
+            else:
+                self._db.execute("UPDATE entries SET accessed_at = ? WHERE url = ?", (now, normalize_url(url)))
+            self._db.commit()
+
+    # 将下载好的临时文件按内容哈希移入 objects 目录，并更新索引
+    def store_file(self, url, tmp_path, headers):
+        sha = hashlib.sha256()
+        with open(tmp_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        size = os.path.getsize(tmp_path)
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)  # 相同内容已存在，直接复用
+        else:
+            os.replace(tmp_path, path)
+
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (normalize_url(url), digest, size, headers.get('content-type'), headers.get('etag'),
+                 headers.get('last-modified'), now, now))
+            self._db.commit()
+            self.pin(digest)
+            if self._total is None:
+                self._total = self._stored_bytes()
+            else:
+                self._total += size
+            over = self._total > self.max_bytes and time.monotonic() >= self._evict_after
+        if over:
+            self.evict()
+        return CacheEntry(url, digest, size, path, headers.get('content-type'), self)
+
+    def _stored_bytes(self):
+        return self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT digest, MAX(size) AS size FROM entries GROUP BY digest)"
+        ).fetchone()[0]
+
+    # 缓存总大小超过上限时，按最近访问时间淘汰最久未使用的内容，一次淘汰到上限的 evict_target
+    # 本进程正在读取的对象和最近访问过的对象（可能正被其他进程读取）不淘汰
+    def evict(self):
+        with self._lock:
+            total = self._stored_bytes()
+            target = self.max_bytes * evict_target
+            removed = []
+            if total > self.max_bytes:
+                recent = time.time() - evict_grace_seconds
+                rows = self._db.execute(
+                    "SELECT digest, MAX(size), MAX(accessed_at) AS last FROM entries GROUP BY digest ORDER BY last"
+                ).fetchall()
+                for digest, size, last in rows:
+                    if total <= target or last >= recent:
+                        break
+                    if digest in self._pinned:
+                        continue
+                    self._db.execute("DELETE FROM entries WHERE digest = ?", (digest,))
+                    removed.append(digest)
+                    total -= size
+                self._db.commit()
+            self._total = total
+            if not removed:
+                self._evict_after = time.monotonic() + 60
+        if not removed:
+            return
+        for digest in removed:
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+        logger.info(f"缓存超过上限，淘汰了{len(removed)}个对象")
+
+    # 抓取 url，优先使用缓存；缓存过期时携带 ETag/Last-Modified 向服务器重新验证
+    # parallel 为 True 时（如 PDF 等大文件），未缓存的内容交给 downloader 分段并行下载，中断后可续传
+    # SQLite 读写放到线程中执行，不阻塞 fetcher 事件循环中的其他抓取
+    # 返回的条目处于占用状态，调用方读取完后需 release（或使用 with 语句）
+    async def afetch(self, url, timeout=None, max_time=None, max_bytes=max_object_bytes, parallel=False):
+        entry, row = await asyncio.to_thread(self.lookup, url)
+        try:
+            return await self._afetch(url, entry, row, timeout, max_time, max_bytes, parallel)
+        except BaseException:
+            if entry is not None:
+                entry.release()
+            raise
+
+    async def _afetch(self, url, entry, row, timeout, max_time, max_bytes, parallel):
+        headers = {}
+        if entry is not None:
+            _, _, _, etag, last_modified, fetched_at = row
+            if time.time() - fetched_at < self.fresh_seconds:
+                await asyncio.to_thread(self.touch, url)
+                logger.debug(f"命中缓存：{url}")
+                return entry
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        if parallel and entry is None:
+            # 同一 url 的并发请求共用一次下载；所有调用方都取消时（如收集器取消预取）下载随之取消
+            await fetcher.ashared(_downloads, normalize_url(url),
+                                  lambda: self._adownload_and_store(url, timeout, max_time, max_bytes))
+            entry, _ = await asyncio.to_thread(self.lookup, url)
+            if entry is None:
+                raise fetcher.FetchError(f"下载的文件已从缓存中淘汰：{url}")
+            return entry
+
+        tmp_path = os.path.join(self.tmp_dir, f"{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}")
+        try:
+            response = await fetcher.afetch_to_file(url, tmp_path, headers=headers or None, timeout=timeout,
+                                                    max_bytes=max_bytes, max_time=max_time)
+            if response.status_code == 304 and entry is not None:
+                await asyncio.to_thread(self.touch, url, True)
+                logger.debug(f"缓存重新验证有效：{url}")
+                return entry
+            response.raise_for_status()
+            stored = await asyncio.to_thread(self.store_file, url, tmp_path, response.headers)
+            if entry is not None:
+                entry.release()
+            return stored
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # 分段并行下载大文件并存入缓存
+    async def _adownload_and_store(self, url, timeout, max_time, max_bytes):
+        # 临时文件名由 url 决定，下载中断后再次抓取同一 url 时可以从断点继续
+        tmp_path = os.path.join(self.tmp_dir, hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest())
+        result = await downloader.adownload(url, tmp_path, timeout=timeout,
+                                            max_time=max_time or downloader.max_download_time,
+                                            max_bytes=max_bytes)
+        # 下载完成后即使调用方已取消也要入库，否则完整的文件会留在 tmp 目录中无人使用
+        store = asyncio.ensure_future(asyncio.to_thread(self.store_file, url, tmp_path, result.headers))
+        store.add_done_callback(lambda f: f.cancelled() or f.exception() or f.result().release())
+        await asyncio.shield(store)
+
+# 获取进程内共享的缓存实例
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RefCache()
+    return _cache
+
+async def afetch(url, **kwargs):
+    return await get_cache().afetch(url, **kwargs)
@@ -0,0 +1,48 @@
+import re
+import math
+from collections import Counter
+
+_word_pattern = re.compile(r'[a-z0-9]+')
+_stop_words = frozenset(
+    "a an and are as at be but by can do does for from how i in is it me my of on or so that the "
+    "this to was what when where which who why will with you your".split())
+_cjk_pattern = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+')
+
+# 轻量分词：英文按单词切分，中文等 CJK 文本取相邻双字，cjk_chars 为 True 时还取单字
+# 单个汉字区分度太低，只在有 IDF 加权的 BM25 中使用；单字成词的文本仍保留该字
+def tokenize(text, cjk_chars=True):
+    text = text.lower()
+    tokens = [word for word in _word_pattern.findall(text) if word not in _stop_words]
+    for run in _cjk_pattern.findall(text):
+        if cjk_chars or len(run) == 1:
+            tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+# 计算查询与每个文档的 BM25 得分，文档集合本身作为 IDF 的统计语料
+def bm25_scores(query, documents, k1=1.5, b=0.75):
+    docs = [Counter(tokenize(doc)) for doc in documents]
+    if not docs:
+        return []
+    lengths = [sum(doc.values()) for doc in docs]
+    avg_length = sum(lengths) / len(docs) or 1.0
+    query_terms = set(tokenize(query))
+    idf = {}
+    for term in query_terms:
+        df = sum(1 for doc in docs if term in doc)
+        idf[term] = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+
+    scores = []
+    for doc, length in zip(docs, lengths):
+        score = 0.0
+        for term in query_terms:
+            tf = doc.get(term, 0)
+            if tf:
+                score += idf[term] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+        scores.append(score)
+    return scores
+
+# 文本中出现的不同查询词的数量，不依赖语料统计，可对单篇文档独立判断
+# 没有 IDF 加权，常见汉字几乎总能命中，CJK 文本只统计双字词
+def matched_terms(query, text):
+    return len(set(tokenize(query, cjk_chars=False)) & set(tokenize(text, cjk_chars=False)))
@@ -0,0 +1,63 @@
+import logging
+import threading
+from serpapi import google_search
+import requests
+import rate_limit
+from kv_cache import SqliteKVCache, make_key
+
+logger = logging.getLogger(__name__)
+
+# SerpApi 搜索结果缓存配置，按 (规范化的 q, hl, gl, num) 缓存，跨会话、跨进程共享
+enabled = True
+cache_path = "cache/search_cache.db"
+ttl = 7 * 24 * 3600  # 缓存有效期（秒）
+lru_size = 1024
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SqliteKVCache(cache_path, table='searches', lru_size=lru_size, ttl=ttl)
+    return _cache
+
+# 规范化查询关键词：去掉首尾空白、合并连续空白、统一小写和逗号
+def normalize_query(q):
+    q = str(q or "").replace('，', ',').lower()
+    return ' '.join(q.split())
+
+def cache_key(params):
+    return make_key(normalize_query(params.get('q')), params.get('hl'), params.get('gl'), str(params.get('num')))
+
+# 查找已缓存的搜索结果，未命中或已过期时返回 None
+def lookup(params):
+    if not enabled:
+        return None
+    result = get_cache().get(cache_key(params))
+    if result is not None:
+        logger.info(f"命中搜索缓存：{params.get('q')}")
+    return result
+
+# 缓存一次成功的搜索结果，出错的结果不缓存
+def store(params, result):
+    if not enabled or not result or 'error' in result:
+        return
+    get_cache().put(cache_key(params), result)
+
+def stats():
+    return get_cache().stats()
+
+# 调用 SerpApi 检索，受限流器控制；限流（429）或服务端错误时按指数退避重试
+def fetch_results(params):
+    def get():
+        response = google_search.GoogleSearch(params).get_response()
+        if response.status_code in rate_limit.retry_status:
+            raise rate_limit.RetryableError(f"SerpApi 返回状态码 {response.status_code}",
+                                            response.status_code,
+                                            rate_limit.parse_duration(response.headers.get('retry-after')),
+                                            response.status_code in rate_limit.throttle_status)
+        return response.json(), response.headers
+    return rate_limit.call('serpapi', get, retry_exceptions=(requests.ConnectionError, requests.Timeout),
+                           with_headers=True)
@@ -0,0 +1,133 @@
+import re
+import sys
+import json
+import uuid
+import threading
+import http.server
+
+# 本地的 OpenAI 兼容批量接口替身，用于测试批量模式：
+# 支持 /files 上传、/batches 创建/查询/取消、/files/{id}/content 下载和同步的 /chat/completions
+# 用户消息中包含 FAIL 的请求在批量结果中返回 500；批量任务在第 polls_to_complete 次查询时完成，为 None 时一直不完成
+# 回复内容为 "{batch|sync} turn{n} [1]. done"，n 为该请求历史中的回答数加 1，便于检查多轮合并是否正确
+class BatchStubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, polls_to_complete=2):
+        super().__init__(('127.0.0.1', port), BatchStubHandler)
+        self.polls_to_complete = polls_to_complete
+        self.files = {}
+        self.batches = {}
+        self.chat_requests = 0
+        self.cancelled = []
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def reply_content(kind, messages):
+    turn = sum(1 for message in messages if message['role'] == 'assistant') + 1
+    return f"{kind} turn{turn} [1]. done"
+
+class BatchStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj=None, raw=None, status=200):
+        body = raw if raw is not None else json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def batch_view(self, batch):
+        view = dict(batch)
+        if view['status'] != 'completed':
+            view['output_file_id'] = None
+        return view
+
+    def upload_file(self, body):
+        boundary = re.search(r'boundary=(.*)', self.headers['Content-Type']).group(1).encode()
+        content = b""
+        for part in body.split(b'--' + boundary):
+            if b'filename=' in part:
+                content = part.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n', 1)[0]
+        file_id = 'file-' + uuid.uuid4().hex[:8]
+        self.server.files[file_id] = content
+        self.send_json({'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': 0,
+                        'filename': 'batch.jsonl', 'purpose': 'batch', 'status': 'processed'})
+
+    def create_batch(self, body):
+        request = json.loads(body)
+        lines = []
+        for line in self.server.files[request['input_file_id']].decode('utf-8').splitlines():
+            record = json.loads(line)
+            messages = record['body']['messages']
+            if 'FAIL' in messages[-1]['content']:
+                response = {'status_code': 500, 'body': {}}
+            else:
+                message = {'role': 'assistant', 'content': reply_content('batch', messages)}
+                response = {'status_code': 200, 'body': {'choices': [{'index': 0, 'message': message}]}}
+            lines.append(json.dumps({'id': 'req', 'custom_id': record['custom_id'], 'response': response, 'error': None}))
+        output_id = 'file-' + uuid.uuid4().hex[:8]
+        self.server.files[output_id] = ('\n'.join(lines) + '\n').encode('utf-8')
+        batch_id = 'batch_' + uuid.uuid4().hex[:8]
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'],
+                 'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+                 'status': 'in_progress', 'created_at': 0, 'output_file_id': output_id,
+                 'request_counts': {'total': len(lines), 'completed': len(lines), 'failed': 0}}
+        self.server.batches[batch_id] = [batch, 0]
+        self.send_json(self.batch_view(batch))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        cancel = re.search(r'/batches/([^/]+)/cancel$', self.path)
+        if self.path.endswith('/files'):
+            self.upload_file(body)
+        elif self.path.endswith('/batches'):
+            self.create_batch(body)
+        elif cancel:
+            batch = self.server.batches[cancel.group(1)][0]
+            batch['status'] = 'cancelled'
+            self.server.cancelled.append(batch['id'])
+            self.send_json(self.batch_view(batch))
+        elif self.path.endswith('/chat/completions'):
+            request = json.loads(body)
+            self.server.chat_requests += 1
+            message = {'role': 'assistant', 'content': reply_content('sync', request['messages'])}
+            self.send_json({'id': 'chat', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}]})
+        else:
+            self.send_json({'error': {'message': 'not found'}}, status=404)
+
+    def do_GET(self):
+        batch_match = re.search(r'/batches/([^/]+)$', self.path)
+        file_match = re.search(r'/files/([^/]+)/content$', self.path)
+        if batch_match:
+            entry = self.server.batches[batch_match.group(1)]
+            entry[1] += 1
+            polls_to_complete = self.server.polls_to_complete
+            if entry[0]['status'] == 'in_progress' and polls_to_complete is not None and entry[1] >= polls_to_complete:
+                entry[0]['status'] = 'completed'
+            self.send_json(self.batch_view(entry[0]))
+        elif file_match:
+            self.send_json(raw=self.server.files[file_match.group(1)])
+        else:
+            self.send_json({'error': {'message': 'not found'}}, status=404)
+
+# 单独运行时作为测试用的本地服务：python tests/batch_stub_server.py 8791
+# 然后以 OPENAI_BASE_URL=http://127.0.0.1:8791/v1 运行 python llm_gen_answer.py batch
+if __name__ == "__main__":
+    server = BatchStubServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8791)
+    print(f"批量接口替身已启动：{server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('PERPLEXITY_API_KEY', 'test')
+
+import llm_batch
+import llm_cache
+import llm_clients
+import llm_gen_answer
+from batch_stub_server import BatchStubServer
+
+references = [{'idx': 1, 'ref_id': 'r1', 'title': 't', 'summary': 's', 'url': 'u'}]
+
+# 批量模式的端到端测试：请求经 llm_batch 提交到本地的批量接口替身，检查结果合并、失败回退和等待超时
+class BatchModeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BatchStubServer().start()
+        self.work_dir = tempfile.mkdtemp()
+        self.saved = (llm_batch.batch_dir, llm_batch.poll_interval, llm_cache.enabled, llm_gen_answer.models,
+                      llm_gen_answer.openai_baseurl)
+        llm_batch.batch_dir = os.path.join(self.work_dir, 'batch')
+        llm_batch.poll_interval = 0.05
+        llm_cache.enabled = False
+
+    def tearDown(self):
+        (llm_batch.batch_dir, llm_batch.poll_interval, llm_cache.enabled, llm_gen_answer.models,
+         llm_gen_answer.openai_baseurl) = self.saved
+        self.server.stop()
+        shutil.rmtree(self.work_dir)
+
+    def client(self):
+        return llm_clients.get_openai_client(self.server.base_url, 'test')
+
+    def write_data(self, name, queries):
+        contents = [{'query': query, 'references': references} for query in queries]
+        file_path = os.path.join(self.work_dir, 'data', f'{name}.json')
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump({'conversations': {'lang': 'English', 'contents': contents}}, file)
+        return file_path
+
+    def test_run_batch_merges_by_custom_id(self):
+        requests = [('a', 'gpt-4o', [{'role': 'user', 'content': 'q'}]),
+                    ('b', 'gpt-4o', [{'role': 'user', 'content': 'FAIL'}])]
+        replies = llm_batch.run_batch(self.client(), 'openai', requests, 'merge')
+        self.assertEqual(replies, {'a': 'batch turn1 [1]. done'})
+
+    def test_wait_batch_times_out_and_cancels(self):
+        self.server.polls_to_complete = None
+        requests = [('a', 'gpt-4o', [{'role': 'user', 'content': 'q'}])]
+        with self.assertRaises(TimeoutError):
+            llm_batch.run_batch(self.client(), 'openai', requests, 'timeout', timeout=0.2)
+        self.assertEqual(len(self.server.cancelled), 1)
+
+    def test_batch_mode_end_to_end(self):
+        llm_gen_answer.models = {'gpt-4o': self.server.base_url}
+        first = self.write_data('first', ['q1', 'FAIL', 'q3'])
+        second = self.write_data('second', ['q1'])
+        llm_gen_answer.read_json_files_batch(os.path.join(self.work_dir, 'data'))
+
+        with open(f'{first}.LLM', 'r', encoding='utf-8') as file:
+            contents = json.load(file)['conversations']['contents']
+        answers = [conversation['answers'][0] for conversation in contents]
+        # 第二轮在批量结果中失败，同步重新生成；各轮的对话历史按顺序合并
+        self.assertEqual([answer['content'] for answer in answers],
+                         ['batch turn1 [1]. done', 'sync turn2 [1]. done', 'batch turn3 [1]. done'])
+        self.assertEqual(self.server.chat_requests, 1)
+        self.assertEqual(answers[0]['sentences'][0]['references'], [{'idx': 1, 'ref_id': 'r1'}])
+        with open(f'{second}.LLM', 'r', encoding='utf-8') as file:
+            contents = json.load(file)['conversations']['contents']
+        self.assertEqual(contents[0]['answers'][0]['content'], 'batch turn1 [1]. done')
+
+    def test_default_batch_model(self):
+        # 默认的 models 中没有支持批量接口的模型时，批量模式使用 openai_model，其他模型同步生成
+        llm_gen_answer.openai_baseurl = self.server.base_url
+        llm_gen_answer.models = {llm_gen_answer.pply_model: self.server.base_url}
+        file_path = self.write_data('default', ['q1'])
+        llm_gen_answer.read_json_files_batch(os.path.join(self.work_dir, 'data'))
+        with open(f'{file_path}.LLM', 'r', encoding='utf-8') as file:
+            answers = json.load(file)['conversations']['contents'][0]['answers']
+        self.assertEqual({answer['model']: answer['content'] for answer in answers},
+                         {llm_gen_answer.pply_model: 'sync turn1 [1]. done',
+                          llm_gen_answer.openai_model: 'batch turn1 [1]. done'})
+
+if __name__ == "__main__":
+    unittest.main()
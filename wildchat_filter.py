@@ -1,12 +1,22 @@
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import numpy as np
 import json, string, datetime, random, os, sys
-import requests
-from serpapi import google_search
-from openai import OpenAI
+import glob, shutil, tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import httpx
+import openai
 import html2text
 import uuid
 import pymupdf
+import misc
+import llm_clients
+import rate_limit
+import fetcher
+import downloader
+import search_cache
+from keyword_session import KeywordSession, split_turn
 
 # 读取Parquet文件
 file_path = 'dataset/train-00002-of-00019.parquet'
@@ -16,11 +26,20 @@ dict_file = 'wildchat_filter.txt'
 temp_file = 'wildchat_filter.tmp'
 data_file = "wildchat_filter.data.v2"
 serpapi_output = 'serpapi_output'
+# 多分片并行处理时，每个分片单独输出的目录
+partition_dir = 'wildchat_filter.parts'
+# turn/topic/lang 统计结果的报告文件
+stats_report_file = 'wildchat_filter.stats.json'
 manually_screened_temp_data_file = 'dataset/train-00002-of-00019_en.txt'
 q2k_prompt = "As a search engine expert, please rewrite the following query content as several search keywords, and the total word count of the generated search keywords should not exceed 200 words. The returned keywords should be separated by commas."
 q2k_prompt_cn = "你作为搜索引擎专家，请重写下面的查询内容为若干查询关键词，生成的查询关键词总字数不查过200字，返回的关键词以逗号间隔即可。"
 LLM_model = "gpt-4o-mini"
 temp_pdf_path = "temp_pdf"
+# 流式读取Parquet时只读取需要的列，以及每批读取的行数
+parquet_columns = ['conversation_hash', 'language', 'turn', 'conversation']
+parquet_batch_size = 1024
+# 人工筛选 hash→topic 索引的二进制边车文件后缀
+topic_index_suffix = '.idx.npy'
 PROMPT = "请提取以下html网页的主体内容，将页头、页脚、导航栏以及所有html标签等无效内容过滤掉，注意只输出主体内容，不再输出其他提示信息。\n\n"
 
 # 自定义一个函数来处理不可JSON序列化的对象
@@ -99,32 +118,83 @@ def read_txt_to_dict(txt_filepath):
     # 返回字典
     return uid_tid_dict
 
+# 已加载的 hash→topic 索引，同一进程内的多个分片共用
+_topic_indexes = {}
+
+# 将 hash→topic 字典转换为按hash排序的结构化数组，便于二分查找和内存映射
+def build_topic_index(uid_tid_dict):
+    hashes = sorted(uid_tid_dict)
+    hash_width = max([len(h.encode('utf-8')) for h in hashes], default=1)
+    topic_width = max([len(uid_tid_dict[h].encode('utf-8')) for h in hashes], default=1)
+    index = np.empty(len(hashes), dtype=[('hash', f'S{hash_width}'), ('topic', f'S{topic_width}')])
+    index['hash'] = [h.encode('utf-8') for h in hashes]
+    index['topic'] = [uid_tid_dict[h].encode('utf-8') for h in hashes]
+    return index
+
+# 将索引保存为 .npy 边车文件，先写临时文件再替换，避免其他进程读到半个文件
+def save_topic_index(index, index_filepath):
+    tmp_filepath = f"{index_filepath}.{os.getpid()}.tmp"
+    with open(tmp_filepath, 'wb') as file:
+        np.save(file, index)
+    os.replace(tmp_filepath, index_filepath)
+
+# 读取 hash→topic 索引：边车文件比文本新时直接内存映射，否则解析文本并重建边车文件
+# 文本文件不存在时与原来一致，只打印错误并返回空索引
+def load_topic_index(txt_filepath):
+    if not os.path.exists(txt_filepath):
+        print(f"Error: The file '{txt_filepath}' was not found.")
+        return build_topic_index({})
+    index_filepath = txt_filepath + topic_index_suffix
+    if os.path.exists(index_filepath) and os.path.getmtime(index_filepath) >= os.path.getmtime(txt_filepath):
+        return np.load(index_filepath, mmap_mode='r')
+
+    index = build_topic_index(read_txt_to_dict(txt_filepath))
+    try:
+        save_topic_index(index, index_filepath)
+    except OSError as e:
+        print(f"Warning: Failed to save topic index to '{index_filepath}': {e}")
+    return index
+
+# 获取指定文本文件的 hash→topic 索引，每个进程只加载一次
+def get_topic_index(txt_filepath):
+    key = os.path.abspath(txt_filepath)
+    if key not in _topic_indexes:
+        _topic_indexes[key] = load_topic_index(txt_filepath)
+    return _topic_indexes[key]
+
+# 在索引中二分查找 conversation_hash 对应的 topic，不存在时返回 None
+def lookup_topic(index, conversation_hash):
+    key = conversation_hash.encode('utf-8')
+    hashes = index['hash']
+    if len(key) > hashes.dtype.itemsize:
+        return None
+    pos = np.searchsorted(hashes, key)
+    if pos < len(hashes) and hashes[pos] == key:
+        return index['topic'][pos].decode('utf-8')
+    return None
+
 def append_dict_to_json_file(data_dict, file_path):
     """
     将字典转换为JSON格式的字符串，并追加到指定文件中。
     如果文件不存在，仅创建该文件。
+    需要连续写入多条记录时，应直接使用 misc.JsonlWriter，避免每条记录都打开关闭一次文件。
 
     参数:
     data_dict (dict): 需要转换为JSON的字典。
     file_path (str): 追加JSON字符串的目标文件路径。
     """
     try:
-        # 如果文件不存在，则创建一个空文件
-        if not os.path.exists(file_path):
-            open(file_path, 'w').close()
-
-        # 将字典转换为JSON格式的字符串
-        # json_string = json.dumps(data_dict, ensure_ascii=False, indent=4) + '\n'
-        json_string = json.dumps(data_dict, ensure_ascii=False) + '\n'
-
-        # 追加JSON字符串到文件
-        with open(file_path, 'a', encoding='utf-8') as file:
-            file.write(json_string)
+        with misc.JsonlWriter(file_path) as writer:
+            writer.write(data_dict)
     except IOError as e:
         print(f"An IOError occurred: {e}")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
+# 打开流水线输出用的 JSONL 写入器，关闭时 fsync 保证数据落盘
+def open_jsonl_writer(file_path, file_mode='a'):
+    return misc.JsonlWriter(file_path, file_mode, fast=True, fsync=True)
+
 def check_first_word(input_string):
     # 检查输入是否为null、空字符串或仅包含空格
     if input_string is None or input_string.strip() == "":
@@ -145,179 +215,257 @@ def check_first_word(input_string):
     else:
         return "no"
 
+# 将一条WildChat记录组装为输出的json结构
+def build_conversation_record(row_dict, topic_id):
+    lang = row_dict['language']
+    turn = row_dict['turn']
+    conversation_hash = row_dict['conversation_hash']
+    random_code = generate_random_code()
+
+    json_data = {'id': random_code, 'conversation_hash': conversation_hash}
+    conv = {'turn': turn, 'lang':lang, 'topic': topic_id}
+    i = 0
+    contents = []
+    while i < turn*2:
+        query = row_dict['conversation'][i]['content']
+        answer = row_dict['conversation'][i+1]['content']
+        content = {'query': query, 'answer': answer}
+        contents.append(content)
+        i = i + 2
+    conv['contents'] = contents
+    json_data['conversations'] = conv
+    return json_data
+
 def data_process(data):
     # 使用for循环迭代DataFrame中的每一行
     count = 0
-    for index, row in data.iterrows():
-        # 将DataFrame的行转换为字典
-        row_dict = row.to_dict()
-
-        # 获取临时记录
-        temp_dict = read_txt_to_dict(manually_screened_temp_data_file)
-
-        lang = row_dict['language']
-        turn = row_dict['turn']
-        conversation_hash = row_dict['conversation_hash']
-
-        if conversation_hash in temp_dict:
-            topic_id = temp_dict[conversation_hash]
-            random_code = generate_random_code()
-        # if turn < 4 and lang == 'English':
-        #     # 首先判断是否以 5W+H 开头，如果不是则跳过本次循环
-        #     if check_first_word(row_dict['conversation'][0]['content']) == "no":
-        #         continue
-            count = count + 1
-            json_data = {'id': random_code, 'conversation_hash': conversation_hash}
-            conv = {'turn': turn, 'lang':lang, 'topic': topic_id}
-            i = 0
-            contents = []
-            while i < turn*2:
-                query = row_dict['conversation'][i]['content']
-                answer = row_dict['conversation'][i+1]['content']
-                content = {'query': query, 'answer': answer}
-                contents.append(content)
-                i = i + 2
-            conv['contents'] = contents
-            json_data['conversations'] = conv
-            append_dict_to_json_file(json_data, output_jsonfile)
-        else:
+    # 获取临时记录
+    topic_index = get_topic_index(manually_screened_temp_data_file)
+    with open_jsonl_writer(output_jsonfile) as writer:
+        for index, row in data.iterrows():
+            # 将DataFrame的行转换为字典
+            row_dict = row.to_dict()
+
+            conversation_hash = row_dict['conversation_hash']
+            topic_id = lookup_topic(topic_index, conversation_hash)
+
+            if topic_id is not None:
+            # if turn < 4 and lang == 'English':
+            #     # 首先判断是否以 5W+H 开头，如果不是则跳过本次循环
+            #     if check_first_word(row_dict['conversation'][0]['content']) == "no":
+            #         continue
+                count = count + 1
+                json_data = build_conversation_record(row_dict, topic_id)
+                writer.write(json_data)
+            else:
+                continue
+
+    print("总计取出" + str(count) + "条记录")
+
+# 以流式方式逐批读取Parquet文件中命中人工筛选列表的记录
+# 只读取需要的列，hash过滤在Arrow中完成，未命中的行不会被转换为Python对象
+def iter_screened_rows(parquet_filepath, screened_hashes, batch_size=parquet_batch_size):
+    parquet_file = pq.ParquetFile(parquet_filepath)
+    hash_type = parquet_file.schema_arrow.field('conversation_hash').type
+    value_set = pc.cast(pa.array(screened_hashes), hash_type)
+
+    # 先只读取hash列，找出包含命中记录的row group，其余row group整体跳过
+    row_groups = []
+    for i in range(parquet_file.num_row_groups):
+        hashes = parquet_file.read_row_group(i, columns=['conversation_hash']).column('conversation_hash')
+        if pc.any(pc.is_in(hashes, value_set=value_set)).as_py():
+            row_groups.append(i)
+    if not row_groups:
+        return
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=parquet_columns):
+        mask = pc.is_in(batch.column('conversation_hash'), value_set=value_set)
+        matched = batch.filter(mask)
+        if matched.num_rows == 0:
             continue
+        yield from matched.to_pylist()
+
+# data_process 的流式版本，内存占用只与批大小相关，与Parquet文件大小无关
+def data_process_stream(parquet_filepath, topic_filepath, output_filepath):
+    topic_index = get_topic_index(topic_filepath)
+    count = 0
+    with open_jsonl_writer(output_filepath) as writer:
+        for row_dict in iter_screened_rows(parquet_filepath, topic_index['hash']):
+            json_data = build_conversation_record(row_dict, lookup_topic(topic_index, row_dict['conversation_hash']))
+            writer.write(json_data)
+            count = count + 1
 
     print("总计取出" + str(count) + "条记录")
+    return count
 
-def count_turn_and_topic_values(txt_filepath, lang):
-    # 初始化计数器
-    turn1_count = 0
-    turn2_count = 0
-    turn3_count = 0
-    topic1_count = 0
-    topic2_count = 0
-    topic3_count = 0
-    topic4_count = 0
-    topic5_count = 0
-    topic6_count = 0
-    topic7_count = 0
-    topic8_count = 0
-
-    # 以utf8格式逐行读取文件
-    with open(txt_filepath, 'r', encoding='utf8') as file:
+# 一次读取JSONL文件，将每条记录的 turn、topic、lang 读入列式数组
+def load_stat_columns(txt_filepath):
+    turns, topics, langs = [], [], []
+    errors = 0
+    with open(txt_filepath, 'rb') as file:
         for line in file:
+            if not line.strip():
+                continue
             try:
-                # 将读取的每行字符串解析为json格式数据，并转换为dict数据结构
-                data = json.loads(line.strip())
-
-                if data['conversations']['lang'] == lang:
-                    # 根据'turn'的值进行统计
-                    turn = data['conversations']['turn']
-                    if turn == 1:  # 假设每行都包含'turn'键
-                        turn1_count += 1
-                    elif turn == 2:
-                        turn2_count += 1
-                    elif turn == 3:
-                        turn3_count += 1
-
-                    # 根据'topic'的值进行统计
-                    topic = data['conversations']['topic']  # 假设每行都包含'topic'键
-                    if topic == '1':
-                        topic1_count += 1
-                    elif topic == '2':
-                        topic2_count += 1
-                    elif topic == '3':
-                        topic3_count += 1
-                    elif topic == '4':
-                        topic4_count += 1
-                    elif topic == '5':
-                        topic5_count += 1
-                    elif topic == '6':
-                        topic6_count += 1
-                    elif topic == '7':
-                        topic7_count += 1
-                    elif topic == '8':
-                        topic8_count += 1
-                else:
-                    continue
-
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON from line: {line.strip()} - {e}")
+                conv = misc.loads_json_line(line)['conversations']
+                turns.append(int(conv['turn']))
+                topics.append(str(conv['topic']))
+                langs.append(str(conv['lang']))
+            except (ValueError, TypeError) as e:
+                errors += 1
+                print(f"Error decoding JSON from line: {line.decode('utf-8', 'replace').strip()[:200]} - {e}")
             except KeyError as e:
+                errors += 1
                 print(f"Missing key in JSON data: {e}")
+    return np.array(turns, dtype=np.int64), np.array(topics, dtype=str), np.array(langs, dtype=str), errors
+
+# 按数值优先的自然顺序排序 topic 等取值
+def natural_key(value):
+    value = str(value)
+    return (0, int(value), value) if value.isdigit() else (1, 0, value)
+
+# 单次遍历统计 lang × topic × turn 的三维直方图，支持任意 turn 和 topic 取值
+def compute_turn_topic_stats(turns, topics, langs):
+    lang_values, lang_codes = np.unique(langs, return_inverse=True)
+    topic_values, topic_codes = np.unique(topics, return_inverse=True)
+    turn_values, turn_codes = np.unique(turns, return_inverse=True)
+    shape = (len(lang_values), len(topic_values), len(turn_values))
+    flat = (lang_codes * shape[1] + topic_codes) * shape[2] + turn_codes
+    histogram = np.bincount(flat, minlength=int(np.prod(shape))).reshape(shape)
+
+    topic_order = sorted(range(len(topic_values)), key=lambda k: natural_key(topic_values[k]))
+    stats = {'total': int(histogram.sum()), 'langs': {}}
+    for li, lang in enumerate(lang_values):
+        lang_hist = histogram[li]
+        turn_counts = lang_hist.sum(axis=0)
+        topic_counts = lang_hist.sum(axis=1)
+        stats['langs'][str(lang)] = {
+            'total': int(lang_hist.sum()),
+            'turn': {str(turn_values[k]): int(turn_counts[k]) for k in range(len(turn_values)) if turn_counts[k]},
+            'topic': {str(topic_values[k]): int(topic_counts[k]) for k in topic_order if topic_counts[k]},
+            'topic_turn': {
+                str(topic_values[k]): {str(turn_values[t]): int(lang_hist[k, t]) for t in range(len(turn_values)) if lang_hist[k, t]}
+                for k in topic_order if topic_counts[k]
+            },
+        }
+    return stats
+
+# 统计 JSONL 文件中各语言的 turn 与 topic 分布
+def load_stats(txt_filepath):
+    turns, topics, langs, errors = load_stat_columns(txt_filepath)
+    stats = compute_turn_topic_stats(turns, topics, langs)
+    stats['source'] = txt_filepath
+    stats['errors'] = errors
+    return stats
+
+# 统计 JSONL 文件中各语言的 turn 与 topic 分布，并写入机器可读的报告文件
+def build_stats_report(txt_filepath, report_filepath=stats_report_file):
+    stats = load_stats(txt_filepath)
+    with misc.JsonlWriter(report_filepath, 'w', indent=4) as writer:
+        writer.write(stats)
+    return stats
+
+# 打印指定语言的 turn1-3 与 topic1-8 计数，输出与原来一致；指定 report_filepath 时同时写入完整的统计报告
+def count_turn_and_topic_values(txt_filepath, lang, report_filepath=None):
+    stats = build_stats_report(txt_filepath, report_filepath) if report_filepath else load_stats(txt_filepath)
+    lang_stats = stats['langs'].get(lang, {'turn': {}, 'topic': {}})
 
     # 打印统计结果
     print("Counts for 'turn' and 'topic' values:")
-    print(f"turn1_count: {turn1_count}")
-    print(f"turn2_count: {turn2_count}")
-    print(f"turn3_count: {turn3_count}")
-    print(f"topic1_count: {topic1_count}")
-    print(f"topic2_count: {topic2_count}")
-    print(f"topic3_count: {topic3_count}")
-    print(f"topic4_count: {topic4_count}")
-    print(f"topic5_count: {topic5_count}")
-    print(f"topic6_count: {topic6_count}")
-    print(f"topic7_count: {topic7_count}")
-    print(f"topic8_count: {topic8_count}")
+    for turn in range(1, 4):
+        print(f"turn{turn}_count: {lang_stats['turn'].get(str(turn), 0)}")
+    for topic in range(1, 9):
+        print(f"topic{topic}_count: {lang_stats['topic'].get(str(topic), 0)}")
 
 def process_json_lines(src_filepath, dict_filepath, tmp_filepath):
-    # 确保输出文件存在，如果不存在则创建
-    if not os.path.exists(dict_filepath):
-        open(dict_filepath, 'a').close()
-    if not os.path.exists(tmp_filepath):
-        open(tmp_filepath, 'a').close()
-
-    # 打开源文件并逐行读取
-    with open(src_filepath, 'r', encoding='utf-8') as src_file:
-        for line in src_file:
-            try:
-                # 解析JSON格式的字符串
-                row_dict = json.loads(line)
-                
-                # 检查并修改 'conversations' 下的 'topic' 值
-                if 'conversations' in row_dict and 'topic' in row_dict['conversations']:
-                    if row_dict['conversations']['topic'] == "3":
-                        row_dict['conversations']['topic'] = "4"  # 修改topic为4
-                
-                # 根据 'topic' 的值写入不同的文件
-                if row_dict['conversations']['topic'] == "2":
-                    append_dict_to_json_file(row_dict, temp_file)
-                else:
-                    append_dict_to_json_file(row_dict, dict_file)
+    # 两个输出文件各只打开一次，不存在时自动创建
+    with open_jsonl_writer(dict_filepath) as dict_writer, open_jsonl_writer(tmp_filepath) as tmp_writer:
+        # 打开源文件并逐行读取
+        with open(src_filepath, 'r', encoding='utf-8') as src_file:
+            for line in src_file:
+                try:
+                    # 解析JSON格式的字符串
+                    row_dict = json.loads(line)
+
+                    # 检查并修改 'conversations' 下的 'topic' 值
+                    if 'conversations' in row_dict and 'topic' in row_dict['conversations']:
+                        if row_dict['conversations']['topic'] == "3":
+                            row_dict['conversations']['topic'] = "4"  # 修改topic为4
+
+                    # 根据 'topic' 的值写入不同的文件
+                    if row_dict['conversations']['topic'] == "2":
+                        tmp_writer.write(row_dict)
+                    else:
+                        dict_writer.write(row_dict)
 
-            except json.JSONDecodeError:
-                print(f"Warning: Failed to decode JSON from line: {line}")
-            except KeyError as e:
-                print(f"Warning: Missing key in JSON data - {e}")
+                except json.JSONDecodeError:
+                    print(f"Warning: Failed to decode JSON from line: {line}")
+                except KeyError as e:
+                    print(f"Warning: Missing key in JSON data - {e}")
 
 def merge_and_save_files(data_filepath, f1_filepath, f2_filepath):
-    # 读取文件内容
+    # 以固定大小的块流式拷贝两个文件，内存占用与文件大小无关
     try:
-        with open(f1_filepath, 'r', encoding='utf-8') as file1:
-            content_f1 = file1.read()
-        
-        with open(f2_filepath, 'r', encoding='utf-8') as file2:
-            content_f2 = file2.read()
-        
-        # 合并内容
-        merged_content = content_f1 + content_f2
-        
-        # 将合并后的内容写入data_filepath
-        with open(data_filepath, 'w', encoding='utf-8') as data_file:
-            data_file.write(merged_content)
-            
+        with open(data_filepath, 'wb') as data_file:
+            for filepath in (f1_filepath, f2_filepath):
+                with open(filepath, 'rb') as file:
+                    shutil.copyfileobj(file, data_file, 1024 * 1024)
+
     except FileNotFoundError as e:
         print(f"Error: One of the files does not exist - {e}")
     except Exception as e:
         print(f"An error occurred: {e}")
 
+# 单次遍历完成 process_json_lines 的 topic 修改与拆分，以及 merge_and_save_files 的合并
+# topic 不为 2 的记录直接写入目标文件，topic 为 2 的记录暂存到临时文件，最后流式追加到目标文件末尾
+def process_and_merge_json_lines(src_filepath, data_filepath):
+    count = 0
+    spool_dir = os.path.dirname(os.path.abspath(data_filepath))
+    with open_jsonl_writer(data_filepath, 'w') as data_writer, tempfile.TemporaryFile(dir=spool_dir) as spool:
+        with open(src_filepath, 'rb') as src:
+            for line in src:
+                if not line.strip():
+                    continue
+                try:
+                    row_dict = misc.loads_json_line(line)
+                    conv = row_dict['conversations']
+                    if conv.get('topic') == "3":
+                        conv['topic'] = "4"  # 修改topic为4
+                    # 所有记录都按相同格式重新序列化，输出文件中不会混用两种 JSON 格式
+                    line = misc.dumps_json_bytes(row_dict, fast=data_writer.fast) + b'\n'
+
+                    if conv['topic'] == "2":
+                        spool.write(line)
+                    else:
+                        data_writer.write_line(line)
+                    count += 1
+                except (ValueError, TypeError):
+                    print(f"Warning: Failed to decode JSON from line: {line}")
+                except KeyError as e:
+                    print(f"Warning: Missing key in JSON data - {e}")
+
+        spool.seek(0)
+        for chunk in iter(lambda: spool.read(1024 * 1024), b''):
+            data_writer.write_bytes(chunk)
+    return count
+
 def query_to_keyword(query_string):
-    client = OpenAI(
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
-    completion = client.chat.completions.create(
-        model = LLM_model,
-        messages=[
-            {"role": "user", "content": f"{query_string}"}
-        ]
-    )
-    return completion.choices[0].message.content
+    return chat_to_keyword([{"role": "user", "content": f"{query_string}"}])
+
+# 调用 OpenAI 生成回复；客户端不自动重试，由 openai 限流器控制并发，限流或临时错误时退避重试
+def chat_completion(messages):
+    client = llm_clients.get_openai_client(api_key=os.environ.get("OPENAI_API_KEY"))
+    def create():
+        raw = client.chat.completions.with_raw_response.create(
+            model = LLM_model,
+            messages=messages
+        )
+        return raw.parse().choices[0].message.content, raw.headers
+    return rate_limit.call('openai', create, retry_exceptions=(openai.APIConnectionError,), with_headers=True)
+
+# 用完整的消息列表生成关键词，供按轮次追加消息的关键词会话使用
+def chat_to_keyword(messages):
+    return chat_completion(messages)
 
 def get_organic_results(json_str):
     try:
@@ -345,11 +493,13 @@ def get_organic_results(json_str):
         print(f"Error decoding JSON: {e}")
         return ""
 
-def search_and_save(params, num, filename):
-    search = google_search.GoogleSearch(params)
-    result = search.get_dict()
+def search_and_save(params, num, writer):
+    result = search_cache.lookup(params)
+    if result is None:
+        result = search_cache.fetch_results(params)
+        search_cache.store(params, result)
     result = {num: result}
-    append_dict_to_json_file(result, filename)
+    writer.write(result)
 
 def serpapi_search(data_filepath, output_filepath):
     # 确保输出目录存在
@@ -375,54 +525,29 @@ def serpapi_search(data_filepath, output_filepath):
             if lang == 'English':
                 params['hl'] = 'en'
                 params['gl'] = 'us'
-                query = "query:"
-                answer = "answer:"
-                query_string = q2k_prompt
+                session = KeywordSession(q2k_prompt, "query:", "answer:", chat_to_keyword)
             elif lang == 'Chinese':
                 params['hl'] = 'zh-cn'
                 params['gl'] = 'cn'
-                query = "问："
-                answer = "答："
-                query_string = q2k_prompt_cn
+                session = KeywordSession(q2k_prompt_cn, "问：", "答：", chat_to_keyword)
 
             # 构建输出文件的文件名
             filename = f"{output_filepath}/{row_dict['conversation_hash']}.data"
             contents = row_dict['conversations']['contents']
-            # 遍历列表中的每个字典
-            for i in range(len(contents)):
-                # 初始化一个空字符串用于存放当前的输出结果
-                if lang == 'English':
-                    query_string = q2k_prompt
-                elif lang == 'Chinese':
-                    query_string = q2k_prompt_cn
-                
-                # 对于当前索引i，输出从索引0到i的所有字典中的键值对
-                for j in range(i + 1):
-                    # 遍历每个字典中的键值对
-                    for key, value in contents[j].items():
-                        # 根据键的名称来决定输出的前缀
-                        if "query" in key:
-                            query_string += f"{query} {value}\n"
-                        elif "answer" in key:
-                            if j < i:
-                                query_string += f"{answer} {value}\n"
-                
-                keyword = query_to_keyword(query_string)
-                params['q'] = keyword
-                # print(f"===keyword: {keyword}\n")
-                search_and_save(params, i+1, filename)
+            # 每个会话的搜索结果文件只打开一次
+            with open_jsonl_writer(filename) as writer:
+                # 遍历列表中的每个字典，每轮只向关键词会话追加新的问答
+                for i in range(len(contents)):
+                    query, answer = split_turn(contents[i])
+                    keyword = session.next_keyword(query, answer)
+                    params['q'] = keyword
+                    # print(f"===keyword: {keyword}\n")
+                    search_and_save(params, i+1, writer)
 
 def content_filter_LLM(content):
-    client = OpenAI(
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
-    completion = client.chat.completions.create(
-        model = LLM_model,
-        messages=[
-            {"role": "user", "content": f"{PROMPT}{content}"}
-        ]
-    )
-    return completion.choices[0].message.content
+    return chat_completion([
+        {"role": "user", "content": f"{PROMPT}{content}"}
+    ])
 
 def content_filter(html_content):
     # 创建一个 HTML 到 Markdown 的转换器实例
@@ -438,16 +563,14 @@ def content_filter(html_content):
 
 def fetch_url_content(url):
     try:
-        # 发送GET请求
-        response = requests.get(url)
-        # 尝试从HTTP头信息中获取编码
-        encoding = response.apparent_encoding
+        # 通过共享连接池发送GET请求
+        response = fetcher.fetch(url)
         # 确保请求成功
         response.raise_for_status()
-        # 根据编码解码网页内容
-        content = response.content.decode(encoding)
+        # 根据推断的编码解码网页内容
+        content = response.text()
         return content_filter(content)
-    except requests.RequestException as e:
+    except (httpx.HTTPError, fetcher.FetchError) as e:
         # 打印错误信息
         print(f"An error occurred: {e}")
         return None
@@ -469,19 +592,13 @@ def download_pdf(url, directory):
     # 完整的文件路径
     file_path = os.path.join(directory, file_name)
     
-    # 发送HTTP GET请求
-    response = requests.get(url, stream=True)
-    
-    # 检查请求是否成功
-    if response.status_code == 200:
-        # 打开文件进行写入
-        with open(file_path, 'wb') as file:
-            # 写入内容到文件
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        # print(f"PDF文件已下载并保存到：{file_path}")
-    else:
-        print(f"下载失败，状态码：{response.status_code}")
+    # 探测是否支持分段下载，支持时分段并行写入文件，否则流式写入文件
+    try:
+        downloader.download(url, file_path)
+    except httpx.HTTPStatusError as e:
+        print(f"下载失败，状态码：{e.response.status_code}")
+    except (httpx.HTTPError, fetcher.FetchError) as e:
+        print(f"下载失败：{e}")
     return file_path
 
 def fetch_pdf_text(pdf_filepath):
@@ -490,6 +607,83 @@ def fetch_pdf_text(pdf_filepath):
     return text
 
 def main():
+    try:
+        data_process_stream(file_path, manually_screened_temp_data_file, output_jsonfile)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# 解析分片参数，支持目录（取其中所有parquet文件）或通配符
+def resolve_shard_paths(shards):
+    if os.path.isdir(shards):
+        return sorted(glob.glob(os.path.join(shards, '*.parquet')))
+    return sorted(glob.glob(shards))
+
+# 单个分片的处理入口，在子进程中运行，结果写入该分片独立的输出文件
+def process_shard(parquet_filepath, topic_filepath, partition_filepath):
+    if os.path.exists(partition_filepath):
+        os.remove(partition_filepath)
+    count = data_process_stream(parquet_filepath, topic_filepath, partition_filepath)
+    return count
+
+# 按分片顺序将各分片的输出文件追加合并到最终输出文件
+def merge_partitions(partition_filepaths, output_filepath):
+    with open(output_filepath, 'ab') as output_file:
+        for partition_filepath in partition_filepaths:
+            if not os.path.exists(partition_filepath):
+                continue
+            with open(partition_filepath, 'rb') as partition_file:
+                shutil.copyfileobj(partition_file, output_file, 1024 * 1024)
+
+# 使用进程池并行处理多个分片，每个分片输出到独立文件，全部成功后统一合并
+# 有分片失败时不合并，避免把不完整的结果追加到输出文件，返回是否成功
+def main_multi(shards, max_workers=None):
+    shard_paths = resolve_shard_paths(shards)
+    if not shard_paths:
+        print(f"Error: No parquet files found for '{shards}'.")
+        return False
+
+    # 在父进程中预先生成topic索引的边车文件，子进程直接内存映射即可
+    get_topic_index(manually_screened_temp_data_file)
+    if not os.path.exists(partition_dir):
+        os.makedirs(partition_dir)
+
+    partitions = {}
+    failed = []
+    total = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for shard_path in shard_paths:
+            name = os.path.splitext(os.path.basename(shard_path))[0]
+            partition_filepath = os.path.join(partition_dir, f"{name}.json")
+            future = executor.submit(process_shard, shard_path, manually_screened_temp_data_file, partition_filepath)
+            futures[future] = (shard_path, partition_filepath)
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            shard_path, partition_filepath = futures[future]
+            try:
+                count = future.result()
+            except Exception as e:
+                print(f"[{done}/{len(shard_paths)}] {shard_path} 处理失败: {e}")
+                failed.append(shard_path)
+                continue
+            partitions[shard_path] = partition_filepath
+            total += count
+            print(f"[{done}/{len(shard_paths)}] {shard_path} 取出{count}条记录")
+
+    partition_filepaths = [partitions[p] for p in shard_paths if p in partitions]
+    if failed:
+        for partition_filepath in partition_filepaths:
+            os.remove(partition_filepath)
+        print(f"Error: {len(failed)}/{len(shard_paths)}个分片处理失败，未合并到{output_jsonfile}: {', '.join(failed)}")
+        return False
+    merge_partitions(partition_filepaths, output_jsonfile)
+    for partition_filepath in partition_filepaths:
+        os.remove(partition_filepath)
+    print(f"{len(partition_filepaths)}/{len(shard_paths)}个分片处理完成，总计取出{total}条记录，已合并到{output_jsonfile}")
+    return True
+
+# 原有的整表读取方式，整个分片会被一次性载入内存
+def main_full_read():
     try:
         parquet_file = pq.ParquetFile(file_path)
         table = parquet_file.read()
@@ -501,11 +695,16 @@ def main():
 def static(lang):
     count_turn_and_topic_values(output_jsonfile, lang)
 
+def static_all():
+    stats = build_stats_report(output_jsonfile)
+    print(f"总计{stats['total']}条记录，{len(stats['langs'])}种语言，报告已保存到{stats_report_file}")
+
 def merge():
     process_json_lines(src_file, dict_file, temp_file)
 
 def merge_save():
-    merge_and_save_files(data_file, dict_file, temp_file)
+    count = process_and_merge_json_lines(src_file, data_file)
+    print(f"总计合并{count}条记录到{data_file}")
 
 def search_ref():
     serpapi_search(src_file, serpapi_output)
@@ -516,8 +715,17 @@ if __name__ == "__main__":
             static('Chinese')
         elif sys.argv[1] == "static_en":
             static('English')
+        elif sys.argv[1] == "static":
+            static_all()
         elif sys.argv[1] == "main":
-            main()
+            if len(sys.argv) > 2:
+                max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+                if not main_multi(sys.argv[2], max_workers):
+                    sys.exit(1)
+            else:
+                main()
+        elif sys.argv[1] == "main_full_read":
+            main_full_read()
         elif sys.argv[1] == "merge":
             merge()
         elif sys.argv[1] == "merge_save":